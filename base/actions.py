@@ -3,12 +3,23 @@ import requests
 from ldap import modlist
 from django.conf import settings
 from . import auth as ad_auth
+from . import ldap_pool
+from . import middleware
+from . import notifications
+from . import outbox
 import base
+import collections
+import contextlib
+import copy
 import datetime
 import models
+import threading
+import time
+import uuid
 from django.contrib.auth.models import User
-from django.db.models import Count, Q
-from django.core.mail import send_mail, get_connection, EmailMessage
+from django.db import connection, transaction
+from django.db.models import Q
+from django.core.mail import send_mail
 from django.template import Context, RequestContext
 from django.template.loader import get_template
 from django.core.cache import cache
@@ -17,7 +28,11 @@ from . import email_templates
 import smtplib
 import logging
 
-GLOBAL_SETTINGS_OBJECT = 'GLOBAL_SETTINGS_OBJECT'
+GLOBAL_SETTINGS_VERSION = 'GLOBAL_SETTINGS_VERSION'
+# Changed whenever an ArchivedEmail is saved or deleted, see get_fragment_version
+ARCHIVE_VERSION = 'ARCHIVE_VERSION'
+# This process's copy of GlobalSettings and the version it was loaded at, see _get_cached_global_settings
+_global_settings = {'object': None, 'version': None, 'checked': 0}
 
 # For checking that generated passwords meet AD complexity requirements
 UPPER = re.compile('.*[A-Z].*')
@@ -31,7 +46,7 @@ AD_AUTH = ad_auth.ActiveDirectoryAuthenticationBackend()
 def email_participants(subject, content, audience, sender):
     prefix = get_global_setting('competition_prefix')
     if prefix:
-        subject = "[{}] {}".format(prefix, subject)
+        subject, content = email_templates.render('participant_email', prefix=prefix, subject=subject, content=content)
 
     emails = User.objects.filter(is_superuser=False)
     if audience == 'all':
@@ -62,42 +77,87 @@ def email_participants(subject, content, audience, sender):
     # Send the message to staff first also
     emails.insert(0, settings.EMAIL_FROM_ADDR)
 
-    models.ArchivedEmail(subject=subject, content=content, audience=audience, sender=sender).save()
+    archived = models.ArchivedEmail.objects.create(subject=subject, content=content, audience=audience, sender=sender)
+    outbox.queue_email(archived, emails)
 
-    # Reuse the connection to avoid reopening the connection
-    connection = get_connection()
-    for recipient in emails:
-        email = EmailMessage(subject=subject,
-                             body=content,
-                             to=(recipient,),
-                             from_email=settings.EMAIL_FROM_ADDR,
-                             connection=connection)
-        try:
-            email.send(fail_silently=False)
-            logging.info("Sent email to {email}".format(email=recipient))
-        except smtplib.SMTPException:
-            logging.warning("Failed to send email to {email}:\n{body}".format(email=recipient, body=content))
+    # The sendoutbox command picks the messages up unless the outbox is turned off
+    if not settings.EMAIL_OUTBOX_ASYNC:
+        outbox.send_pending(archived=archived)
+    return archived
 
 
 def get_current_teams():
-    return models.Team.objects.exclude(disbanded=True).annotate(member_count=Count('participant'))
+    return models.Team.objects.exclude(disbanded=True)
+
+
+def _new_global_settings_version():
+    version = uuid.uuid4().hex
+    cache.set(GLOBAL_SETTINGS_VERSION, version, None)
+    return version
 
 
-def reset_global_settings_object():
-    gs = models.GlobalSettings.objects.get_or_create(id__exact=1)[0]
-    cache.set(GLOBAL_SETTINGS_OBJECT, gs)
-    return gs
+def reset_global_settings_object(gs=None):
+    """
+    Reload this process's copy of the global settings (or use gs, if it was just saved) and bump the
+    version so every other process reloads too.
+    """
+    if gs is None:
+        gs = models.GlobalSettings.objects.get_or_create(id__exact=1)[0]
+    else:
+        gs = copy.copy(gs)
+    _global_settings.update(object=gs, version=_new_global_settings_version(), checked=time.time())
+    return copy.copy(gs)
+
+
+def expire_global_settings():
+    """
+    Make the next lookup check the version again; called at the start of every request.
+    """
+    _global_settings['checked'] = 0
+
+
+def _get_cached_global_settings():
+    now = time.time()
+    if _global_settings['object'] is None or \
+            now - _global_settings['checked'] > settings.GLOBAL_SETTINGS_CHECK_INTERVAL:
+        version = cache.get(GLOBAL_SETTINGS_VERSION)
+        if version is None:
+            # Evicted or memcached restarted, agree on a new version
+            cache.add(GLOBAL_SETTINGS_VERSION, uuid.uuid4().hex, None)
+            version = cache.get(GLOBAL_SETTINGS_VERSION)
+        if _global_settings['object'] is None or version != _global_settings['version']:
+            _global_settings['object'] = models.GlobalSettings.objects.get_or_create(id__exact=1)[0]
+        _global_settings['version'] = version
+        _global_settings['checked'] = now
+    return _global_settings['object']
+
+
+def new_archive_version():
+    cache.set(ARCHIVE_VERSION, uuid.uuid4().hex, None)
+
+
+def get_fragment_version():
+    """
+    A stamp that changes whenever the global settings or the email archive change, for caching
+    template fragments built only from them.
+    """
+    _get_cached_global_settings()
+    archive_version = cache.get(ARCHIVE_VERSION)
+    if archive_version is None:
+        cache.add(ARCHIVE_VERSION, uuid.uuid4().hex, None)
+        archive_version = cache.get(ARCHIVE_VERSION)
+    return "{}-{}".format(_global_settings['version'], archive_version)
 
 
 def get_global_settings_object():
-    gs = cache.get(GLOBAL_SETTINGS_OBJECT)
-    if not gs:
-        gs = reset_global_settings_object()
-    return gs
+    """
+    A copy of the global settings that is safe to modify and save.
+    """
+    return copy.copy(_get_cached_global_settings())
 
 
 def get_global_setting(setting_name):
-    gs = get_global_settings_object()
+    gs = _get_cached_global_settings()
     gs_result = getattr(gs, setting_name)
     if gs_result:
         return gs_result
@@ -114,8 +174,6 @@ def set_global_setting(setting_name, value):
         gs.save()
     except Exception as e:
         return False
-    #Reassign object in memcache
-    reset_global_settings_object()
     return True
 
 
@@ -126,13 +184,16 @@ def render_template(request, template, context=None):
 def get_context(request):
     context = {}
     context['current_url_full'] = request.get_full_path()
-    request.session.__setitem__('ip_addr', request.META.get('HTTP_X_FORWARDED_FOR'))
-    request.session.__setitem__('recent_path', request.META.get('PATH_INFO'))
+    # nginx always sends X-Forwarded-For, so recording it for anonymous visitors would give each one a session
+    if request.user.is_authenticated:
+        middleware.set_session_value(request.session, 'ip_addr', request.META.get('HTTP_X_FORWARDED_FOR'))
+        middleware.set_session_value_lazily(request.session, 'recent_path', request.META.get('PATH_INFO'))
     if request.user:
         context['user'] = request.user
         if isinstance(request.user, User):
-            obj, created = models.Participant.objects.get_or_create(user=request.user)
-            context['participant'] = obj
+            # Without the middleware (e.g. in tests) resolve it right away
+            participant = getattr(request, 'participant', None)
+            context['participant'] = participant if participant is not None else middleware.get_participant(request)
 
     return context
 
@@ -188,22 +249,32 @@ def admin_bind():
         return l
 
 
-# Decorator to automatically handle setting up/tearing down an admin LDAP session if none is provided
+def admin_credentials():
+    return get_global_setting('administrator_bind_dn'), get_global_setting('administrator_bind_pw')
+
+
+# Bound admin connections are reused across calls; the pool rebinds if the admin credentials change
+ADMIN_POOL = ldap_pool.AdminConnectionPool(admin_bind, admin_credentials,
+                                           max_size=settings.AD_POOL_SIZE,
+                                           check_interval=settings.AD_POOL_CHECK_INTERVAL)
+
+
+# Decorator to automatically handle borrowing/returning a pooled admin LDAP session if none is provided
 def ldap_admin_bind(func):
 
     def session(*args, **kwargs):
-        ldap_connection = admin_bind()
+        ldap_connection = ADMIN_POOL.acquire()
         if not ldap_connection:
             return False
 
         kwargs.update(ldap_connection=ldap_connection)
 
+        # Don't hand a connection back to the pool if the operation failed, it may be broken
+        ret = False
         try:
             ret = func(*args, **kwargs)
-        except Exception as e:
-            raise e
         finally:
-            ldap_connection.unbind_s()
+            ADMIN_POOL.release(ldap_connection, discard=ret is False)
         return ret
     return session
 
@@ -218,30 +289,64 @@ def ldap_debug_write(message):
         fObj.close()
 
 
-def get_user_dn(participant_id):
-    participant = models.Participant.objects.get(pk=participant_id)
-    fname = participant.user.first_name
-    lname = participant.user.last_name
-    if participant.is_red:
-        ou = settings.AD_RED_OU
-    elif participant.is_green:
-        ou = settings.AD_GREEN_OU
-    else:
-        ou = settings.AD_CDCUSER_OU
-    user_dn = 'CN={first} {last},OU={ou},{base_dn}'.format(first=fname, last=lname,
-                                                      ou=ou, base_dn=settings.AD_BASE_DN)
+USER_DN_KEY = 'USER_DN_{id}'
+GROUP_DN_KEY = 'GROUP_DN_{id}'
+
+
+def get_user_dn(participant):
+    """
+    Get the AD distinguished name of a participant, given the Participant or its id.
+
+    DNs are cached; the cache entry is dropped when the participant's name or account color changes.
+    """
+    participant_id = getattr(participant, 'pk', participant)
+    key = USER_DN_KEY.format(id=participant_id)
+    user_dn = cache.get(key)
+    if user_dn is None:
+        if not isinstance(participant, models.Participant):
+            participant = models.Participant.objects.select_related('user').get(pk=participant_id)
+        fname = participant.user.first_name
+        lname = participant.user.last_name
+        if participant.is_red:
+            ou = settings.AD_RED_OU
+        elif participant.is_green:
+            ou = settings.AD_GREEN_OU
+        else:
+            ou = settings.AD_CDCUSER_OU
+        user_dn = 'CN={first} {last},OU={ou},{base_dn}'.format(first=fname, last=lname,
+                                                          ou=ou, base_dn=settings.AD_BASE_DN)
+        cache.set(key, user_dn, settings.DN_CACHE_TIMEOUT)
     return user_dn
 
 
-def get_group_dn(team_id):
-    team = models.Team.objects.get(pk=team_id)
-    group = settings.AD_BLUE_TEAM_FORMAT.format(number=team.number)
-    group_dn = 'CN={group},OU={ou},{base_dn}'.format(group=group,
-                                                     ou=settings.AD_CDCUSER_OU,
-                                                     base_dn=settings.AD_BASE_DN)
+def get_group_dn(team):
+    """
+    Get the AD distinguished name of a team's group, given the Team or its id.
+
+    DNs are cached; the cache entry is dropped when the team number changes.
+    """
+    team_id = getattr(team, 'pk', team)
+    key = GROUP_DN_KEY.format(id=team_id)
+    group_dn = cache.get(key)
+    if group_dn is None:
+        if not isinstance(team, models.Team):
+            team = models.Team.objects.get(pk=team_id)
+        group = settings.AD_BLUE_TEAM_FORMAT.format(number=team.number)
+        group_dn = 'CN={group},OU={ou},{base_dn}'.format(group=group,
+                                                         ou=settings.AD_CDCUSER_OU,
+                                                         base_dn=settings.AD_BASE_DN)
+        cache.set(key, group_dn, settings.DN_CACHE_TIMEOUT)
     return group_dn
 
 
+def forget_user_dns(participant_ids):
+    cache.delete_many([USER_DN_KEY.format(id=participant_id) for participant_id in participant_ids])
+
+
+def forget_group_dn(team_id):
+    cache.delete(GROUP_DN_KEY.format(id=team_id))
+
+
 @ldap_admin_bind
 def add_user_to_group(user_dn, group_dn, ldap_connection):
     ml = [(ldap.MOD_ADD, 'member', user_dn)]
@@ -295,6 +400,87 @@ def set_password(participant_id, password, ldap_connection):
     return True
 
 
+@ldap_admin_bind
+def modify_group_members(group_dn, add, remove, ldap_connection):
+    ml = []
+    if remove:
+        ml.append((ldap.MOD_DELETE, 'member', list(remove)))
+    if add:
+        ml.append((ldap.MOD_ADD, 'member', list(add)))
+    if not ml:
+        return True
+
+    ldap_debug_write("MODIFYING MEMBERS OF {}: ADDING {} REMOVING {}".format(group_dn, add, remove))
+    try:
+        ldap_connection.modify_s(group_dn, ml)
+        return True
+    except ldap.LDAPError as e:
+        ldap_debug_write("Error modifying group members, retrying one at a time: " + str(e))
+
+    # AD rejects the whole modify if a single value is already (or not) a member, so apply what we can
+    success = True
+    for op, attribute, user_dns in ml:
+        for user_dn in user_dns:
+            try:
+                ldap_connection.modify_s(group_dn, [(op, 'member', user_dn)])
+            except ldap.LDAPError as e:
+                ldap_debug_write("Error modifying membership of {} in {}: ".format(user_dn, group_dn) + str(e))
+                success = False
+    return success
+
+
+_group_changes = threading.local()
+
+
+@contextlib.contextmanager
+def batch_group_changes():
+    """
+    Collect the group membership changes queued inside the block and apply them as one modify per group
+    once the block exits and the surrounding transaction (if any) commits. If the block raises the changes
+    are dropped, so its database changes should be made in a transaction.atomic() inside the batch to be
+    rolled back with them. Nested blocks are folded into the outermost one.
+    """
+    if getattr(_group_changes, 'pending', None) is not None:
+        yield
+        return
+
+    _group_changes.pending = collections.OrderedDict()
+    try:
+        yield
+    except Exception:
+        _group_changes.pending = None
+        raise
+    pending = _group_changes.pending
+    _group_changes.pending = None
+
+    def apply_group_changes():
+        from base import jobs
+        for group_dn, (add, remove) in pending.items():
+            jobs.enqueue('modify_group_members', group_dn=group_dn, add=list(add), remove=list(remove))
+    transaction.on_commit(apply_group_changes)
+
+
+def queue_group_change(participant, user_dn, group_dn, add=True):
+    """
+    Add or remove a user from an AD group, batched if inside batch_group_changes().
+    """
+    pending = getattr(_group_changes, 'pending', None)
+    if pending is None:
+        from base import jobs
+        action = 'add_user_to_group' if add else 'remove_user_from_group'
+        return jobs.enqueue(action, participant=participant, user_dn=user_dn, group_dn=group_dn)
+
+    to_add, to_remove = pending.setdefault(group_dn, (collections.OrderedDict(), collections.OrderedDict()))
+    if add:
+        # Removing and re-adding the same user cancels out
+        if to_remove.pop(user_dn, None) is None:
+            to_add[user_dn] = True
+    else:
+        if to_add.pop(user_dn, None) is None:
+            to_remove[user_dn] = True
+    return True
+
+
 ##########
 # User accounts
 ##########
@@ -312,6 +498,10 @@ def create_user_account(username, fname, lname, email, color="blue"):
     return create_account(username, fname, lname, email, color)
 
 
+# userAccountControl flag of a disabled account, new accounts stay disabled until their password is set
+ACCOUNT_DISABLED = 0x2
+
+
 @ldap_admin_bind
 def create_account(username, fname, lname, email, acct_type, ldap_connection):
     base_dn = settings.AD_BASE_DN
@@ -335,19 +525,28 @@ def create_account(username, fname, lname, email, acct_type, ldap_connection):
     # Check and see if user exists
     search_filter = '(&(sAMAccountName=' + username + ')(objectClass=person))'
     try:
-        user_results = ldap_connection.search_s(base_dn, ldap.SCOPE_SUBTREE, search_filter, ['distinguishedName'])
+        user_results = ldap_connection.search_s(base_dn, ldap.SCOPE_SUBTREE, search_filter,
+                                                ['distinguishedName', 'mail', 'userAccountControl'])
     except ldap.LDAPError as e:
         ldap_debug_write("Couldn't search for existing username: " + str(e))
         return False
 
     # Check the results
+    existing_dn = None
     if len(user_results) != 0 and user_results[0][0] is not None:
-        ldap_debug_write("User " + username + " already exists in AD: " + user_results[0][1]['distinguishedName'][0])
-        raise base.UsernameAlreadyExistsError()
-
-    user_dn = 'CN={first} {last},OU={ou},{search}'.format(first=fname, last=lname,
-                                                      ou=ou,
-                                                      search=base_dn)
+        existing = user_results[0][1]
+        ldap_debug_write("User " + username + " already exists in AD: " + existing['distinguishedName'][0])
+        # Only resume an account an earlier attempt of this signup added and failed to finish, which is
+        # still disabled. An enabled one (e.g. a returning participant's) is taken
+        disabled = int(existing.get('userAccountControl', ['512'])[0]) & ACCOUNT_DISABLED
+        if existing.get('mail', [None])[0] != str(email) or not disabled:
+            raise base.UsernameAlreadyExistsError()
+        existing_dn = existing['distinguishedName'][0]
+        ldap_debug_write("Resuming creation of " + existing_dn)
+
+    user_dn = existing_dn or 'CN={first} {last},OU={ou},{search}'.format(first=fname, last=lname,
+                                                                      ou=ou,
+                                                                      search=base_dn)
     user_attrs = {}
     user_attrs['objectClass'] = ['top', 'person', 'organizationalPerson', 'user']
     user_attrs['cn'] = str(fname + ' ' + lname)
@@ -367,7 +566,8 @@ def create_account(username, fname, lname, email, acct_type, ldap_connection):
 
     # Add the new user account
     try:
-        ldap_connection.add_s(user_dn, user_ldif)
+        if existing_dn is None:
+            ldap_connection.add_s(user_dn, user_ldif)
     except ldap.ALREADY_EXISTS as e:
         ldap_debug_write("That DN already exists: " + str(e))
         raise base.DuplicateName()
@@ -386,6 +586,9 @@ def create_account(username, fname, lname, email, acct_type, ldap_connection):
     # Add user to appropriate group
     try:
         ldap_connection.modify_s(cdcuser_group_dn, add_member)
+    except (ldap.ALREADY_EXISTS, ldap.TYPE_OR_VALUE_EXISTS):
+        # Added by the attempt being resumed
+        pass
     except ldap.LDAPError as e:
         ldap_debug_write("Error adding user to {group} group: ".format(
             group=group) + str(e))
@@ -411,20 +614,25 @@ def create_account(username, fname, lname, email, acct_type, ldap_connection):
         return False
 
     # Ensure the account exists locally
-    AD_AUTH.get_or_create_user(username, password)
+    user = AD_AUTH.get_or_create_user(username, password)
+    if acct_type in ('red', 'green'):
+        participant = user.participant
+        participant.is_red = acct_type == 'red'
+        participant.is_green = acct_type == 'green'
+        participant.save(update_fields=['is_red', 'is_green'])
 
     # Send email
     if acct_type == 'blue':
-        template = email_templates.ACCOUNT_CREATED
+        template = 'account_created'
     elif acct_type == 'red':
-        template = email_templates.ACCOUNT_CREATED_RED
+        template = 'account_created_red'
     elif acct_type == 'green':
-        template = email_templates.ACCOUNT_CREATED_GREEN
-    email_body = template.format(fname=fname, lname=lname, username=username, password=password,
-                                 support=settings.SUPPORT_EMAIL)
+        template = 'account_created_green'
+    subject, email_body = email_templates.render(template, fname=fname, lname=lname, username=username,
+                                                 password=password)
 
     try:
-        send_mail('Your ISEAGE CDC account', email_body, settings.EMAIL_FROM_ADDR, [email])
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
     except smtplib.SMTPException:
         logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
 
@@ -459,12 +667,11 @@ def update_password(participant_id, old_password, new_password):
     participant = models.Participant.objects.get(pk=participant_id)
 
     email = participant.user.email
-    email_body = email_templates.PASSWORD_UPDATED.format(fname=participant.user.first_name,
-                                                         lname=participant.user.last_name,
-                                                         support=settings.SUPPORT_EMAIL)
+    subject, email_body = email_templates.render('password_updated', fname=participant.user.first_name,
+                                                 lname=participant.user.last_name)
 
     try:
-        send_mail('ISEAGE CDC Support: Password successfully updated', email_body, settings.EMAIL_FROM_ADDR, [email])
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
     except smtplib.SMTPException:
         logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
 
@@ -478,7 +685,6 @@ def forgot_password(email):
         raise User.DoesNotExist()
     for user in users:
         participant, created = models.Participant.objects.get_or_create(user=user)
-        user_dn = get_user_dn(participant.id)
         password = generate_password()
 
         success = set_password(participant.id, password)
@@ -488,11 +694,10 @@ def forgot_password(email):
         # Send email
         username = user.get_username()
         email = user.email
-        email_body = email_templates.PASSWORD_RESET.format(fname=user.first_name, lname=user.last_name,
-                                                           username=username, password=password,
-                                                           support=settings.SUPPORT_EMAIL)
+        subject, email_body = email_templates.render('password_reset', fname=user.first_name, lname=user.last_name,
+                                                     username=username, password=password)
         try:
-            send_mail('ISEAGE CDC Support: Your password has been reset', email_body, settings.EMAIL_FROM_ADDR, [email])
+            send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
         except smtplib.SMTPException:
             logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
 
@@ -503,22 +708,43 @@ def forgot_password(email):
 ##########
 # Teams
 ##########
+# Lowest number in 1..number_of_teams that no active team holds: either 1 or one past a held number
+FREE_TEAM_NUMBER_SQL = """
+SELECT MIN(candidates.candidate) FROM (
+    SELECT 1 AS candidate
+    UNION ALL
+    SELECT number + 1 FROM {table} WHERE disbanded = %s
+) candidates
+WHERE candidates.candidate <= %s AND NOT EXISTS (
+    SELECT 1 FROM {table} taken WHERE taken.number = candidates.candidate AND taken.disbanded = %s
+)
+"""
+
+
+def allocate_team_number(num_teams):
+    """
+    Find the lowest free team number in a single query. Numbers held by disbanded teams are free again.
+    """
+    sql = FREE_TEAM_NUMBER_SQL.format(table=connection.ops.quote_name(models.Team._meta.db_table))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [False, num_teams, False])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
 def assign_team_number(team_id):
     num_teams = get_global_setting('number_of_teams')
-    assigned_numbers = models.Team.objects.values_list('number', flat=True)
-    number = None
 
-    for i in range(1, num_teams + 1):
-        if not i in assigned_numbers:
-            number = i
-            break
+    with transaction.atomic():
+        # Serialize concurrent allocations on the settings row; the lock is held until commit
+        models.GlobalSettings.objects.select_for_update().get(pk=get_global_settings_object().pk)
 
-    if not number:
-        raise base.OutOfTeamNumbersError()
+        number = allocate_team_number(num_teams)
+        if not number:
+            raise base.OutOfTeamNumbersError()
 
-    team = models.Team.objects.get(pk=team_id)
-    team.number = number
-    team.save()
+        models.Team.objects.filter(pk=team_id).update(number=number)
+    forget_group_dn(team_id)
 
     return True
 
@@ -539,11 +765,11 @@ def create_team(name, captain_id):
     captain.save()
 
     email = captain.user.email
-    email_body = email_templates.TEAM_CREATED.format(fname=captain.user.first_name, lname=captain.user.last_name,
-                                team=team.name, number=team.number, support=settings.SUPPORT_EMAIL)
+    subject, email_body = email_templates.render('team_created', fname=captain.user.first_name,
+                                                 lname=captain.user.last_name, team=team.name, number=team.number)
 
     try:
-        send_mail('ISEAGE CDC Support: Team Created', email_body, settings.EMAIL_FROM_ADDR, [email])
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
     except smtplib.SMTPException:
         logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
 
@@ -560,28 +786,20 @@ def add_user_to_team(team_id, participant_id):
     participant.looking_for_team = False
     participant.save()
 
-    if len(team.members()) >= get_global_setting('max_team_size'):
+    if team.is_full():
         team.looking_for_members = False
-        team.save()
+        team.save(update_fields=['looking_for_members'])
 
     # Send email
-    captain_list = team.captains()
-    captains = ""
-    for captain in captain_list:
-        captains += "{fname} {lname}  \t{email}\n".format(fname=captain.user.first_name,
-                                                           lname=captain.user.last_name,
-                                                           email=captain.user.email)
-
     email = participant.user.email
-    email_body = email_templates.JOIN_REQUEST_APPROVED.format(fname=participant.user.first_name,
-                                                              lname=participant.user.last_name,
-                                                              number=team.number,
-                                                              team=team.name,
-                                                              captains=captains,
-                                                              support=settings.SUPPORT_EMAIL)
+    subject, email_body = email_templates.render('join_request_approved', fname=participant.user.first_name,
+                                                 lname=participant.user.last_name,
+                                                 number=team.number,
+                                                 team=team.name,
+                                                 captains=email_templates.captain_list(team.get_captain_roster()))
 
     try:
-        send_mail('ISEAGE CDC Support: You have been added to a team', email_body, settings.EMAIL_FROM_ADDR, [email])
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
     except smtplib.SMTPException:
         logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
 
@@ -598,37 +816,25 @@ def join_team(participant_id, team_id):
     participant.looking_for_team = False
     participant.save()
 
-    if len(team.members()) >= get_global_setting('max_team_size'):
+    if team.is_full():
         team.looking_for_members = False
-        team.save()
+        team.save(update_fields=['looking_for_members'])
 
     # Send email
-    captains = ""
-    for captain in team.captains():
-        captains += "{fname} {lname}  \t{email}\n".format(fname=captain.user.first_name,
-                                                           lname=captain.user.last_name,
-                                                           email=captain.user.email)
-
     email = participant.user.email
-    email_body = email_templates.JOIN_REQUEST_APPROVED.format(fname=participant.user.first_name,
-                                                              lname=participant.user.last_name,
-                                                              number=team.number,
-                                                              team=team.name,
-                                                              captains=captains,
-                                                              support=settings.SUPPORT_EMAIL)
-
-    email_body2 = email_templates.MEMBER_JOINED.format(fname=participant.user.first_name,
-                                                               lname=participant.user.last_name,
-                                                               email=participant.user.email,
-                                                               team=team.name,
-                                                               support=settings.SUPPORT_EMAIL)
+    subject, email_body = email_templates.render('join_request_approved', fname=participant.user.first_name,
+                                                 lname=participant.user.last_name,
+                                                 number=team.number,
+                                                 team=team.name,
+                                                 captains=email_templates.captain_list(team.get_captain_roster()))
 
     try:
-        send_mail('ISEAGE CDC Support: You have been added to a team', email_body, settings.EMAIL_FROM_ADDR, [email])
-        send_mail('ISEAGE CDC Support: Someone has joined your team', email_body2, settings.EMAIL_FROM_ADDR, list(team.captain_emails()))
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
     except smtplib.SMTPException:
         logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
 
+    notifications.notify_captains(team, models.CaptainNotification.MEMBER_JOINED, participant)
+
     return True
 
 
@@ -643,20 +849,7 @@ def leave_team(participant_id):
     participant.requests_captain = False
     participant.save()
 
-    captain_emails = []
-    for captain in team.captains():
-        captain_emails.append(captain.user.email)
-
-    email_body = email_templates.LEFT_TEAM.format(fname=participant.user.first_name,
-                                                  lname=participant.user.last_name,
-                                                  email=participant.user.email,
-                                                  team=team.name,
-                                                  support=settings.SUPPORT_EMAIL)
-
-    try:
-        send_mail('ISEAGE CDC Support: A member has left your team', email_body, settings.EMAIL_FROM_ADDR, captain_emails)
-    except smtplib.SMTPException:
-        logging.warning("Failed to send email to captains of {team}:\n{body}".format(team=team.name, body=email_body))
+    notifications.notify_captains(team, models.CaptainNotification.MEMBER_LEFT, participant)
 
     return True
 
@@ -667,12 +860,11 @@ def promote_to_captain(participant_id):
     ldap_debug_write("PROMOTING {} ON TEAM {}".format(participant, participant.team))
 
     email = participant.user.email
-    email_body = email_templates.CAPTAIN_REQUEST_APPROVED.format(fname=participant.user.first_name,
-                                                                 lname=participant.user.last_name,
-                                                                 support=settings.SUPPORT_EMAIL)
+    subject, email_body = email_templates.render('captain_request_approved', fname=participant.user.first_name,
+                                                 lname=participant.user.last_name)
 
     try:
-        send_mail('ISEAGE CDC Support: You have been promoted to captain', email_body, settings.EMAIL_FROM_ADDR, [email])
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
     except smtplib.SMTPException:
         logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
 
@@ -684,24 +876,12 @@ def demote_captain(participant_id):
     team = participant.team
     ldap_debug_write("DEMOTING {} ON TEAM {}".format(participant, team))
 
-    if len(team.captains()) < 2:
+    if team.captains().count() < 2:
         raise base.OnlyRemainingCaptainError()
 
     participant.demote()
 
-    captain_emails = []
-    for captain in team.captains():
-        captain_emails.append(captain.user.email)
-
-    email_body = email_templates.STEPPED_DOWN.format(fname=participant.user.first_name,
-                                                     lname=participant.user.last_name,
-                                                     team=team.name,
-                                                     support=settings.SUPPORT_EMAIL)
-
-    try:
-        send_mail('ISEAGE CDC Support: A member has stepped down as captain', email_body, settings.EMAIL_FROM_ADDR, captain_emails)
-    except smtplib.SMTPException:
-        logging.warning("Failed to send email to captains of {team}:\n{body}".format(team=team.name, body=email_body))
+    notifications.notify_captains(team, models.CaptainNotification.STEPPED_DOWN, participant)
 
     return True
 
@@ -713,21 +893,7 @@ def submit_join_request(participant_id, team_id):
 
     participant.request_team(team)
 
-    captain_emails = []
-    for captain in team.captains():
-        captain_emails.append(captain.user.email)
-
-    email_body = email_templates.JOIN_REQUEST_SUBMITTED.format(fname=participant.user.first_name,
-                                                               lname=participant.user.last_name,
-                                                               email=participant.user.email,
-                                                               team=team.name,
-                                                               support=settings.SUPPORT_EMAIL)
-
-    try:
-        send_mail('ISEAGE CDC Support: Someone has requested to join your team', email_body, settings.EMAIL_FROM_ADDR,
-                  captain_emails)
-    except smtplib.SMTPException:
-        logging.warning("Failed to send email to captains of {team}:\n{body}".format(team=team.name, body=email_body))
+    notifications.notify_captains(team, models.CaptainNotification.JOIN_REQUEST, participant)
 
     return True
 
@@ -738,21 +904,7 @@ def sumbit_captain_request(participant_id):
 
     participant.request_promotion()
 
-    captain_emails = []
-    for captain in participant.team.captains():
-        captain_emails.append(captain.user.email)
-
-    email_body = email_templates.CAPTAIN_REQUEST_SUBMITTED.format(fname=participant.user.first_name,
-                                                                  lname=participant.user.last_name,
-                                                                  email=participant.user.email,
-                                                                  team=participant.team.name,
-                                                                  support=settings.SUPPORT_EMAIL)
-
-    try:
-        send_mail('ISEAGE CDC Support: Someone has requested to become a captain of your team', email_body,
-                  settings.EMAIL_FROM_ADDR, captain_emails)
-    except smtplib.SMTPException:
-        logging.warning("Failed to send email to captains of {team}:\n{body}".format(team=participant.team.name, body=email_body))
+    notifications.notify_captains(participant.team, models.CaptainNotification.CAPTAIN_REQUEST, participant)
 
     return True
 
@@ -767,14 +919,15 @@ def disband_team(participant_id):
     member_emails = team.member_email_list()
     ldap_debug_write("DISBANDING TEAM {} AT THE REQUEST OF {}".format(participant, team))
 
-    for member in team.members():
-        member.team = None
-        member.save()
+    with batch_group_changes(), transaction.atomic():
+        for member in team.get_roster():
+            member.team = None
+            member.save()
 
-    team.disbanded = True
-    team.save()
+        team.disbanded = True
+        team.save()
 
-    email_body = email_templates.TEAM_DISBANDED.format(team=name, support=settings.SUPPORT_EMAIL)
+    subject, email_body = email_templates.render('team_disbanded', team=name)
 
     if settings.ISCORE_TOKEN:
         # Get Team Number to ID mappings
@@ -793,8 +946,7 @@ def disband_team(participant_id):
             logging.error("Failed to disable team {team} in IScorE!".format(team=name))
 
     try:
-        send_mail('ISEAGE CDC Support: Your team has been disbanded', email_body,
-                  settings.EMAIL_FROM_ADDR, member_emails)
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, member_emails)
     except smtplib.SMTPException:
         logging.warning("Failed to send email to members of {team}:\n{body}".format(team=name, body=email_body))
 
@@ -806,7 +958,7 @@ def _get_group_dn(group, ou):
 
 
 def approve_user(participant):
-    user_dn = get_user_dn(participant.id)
+    user_dn = get_user_dn(participant)
     group_dn = None
     old_group_dn = None
     if participant.is_red:
@@ -822,7 +974,7 @@ def approve_user(participant):
 
 
 def unapprove_user(participant):
-    user_dn = get_user_dn(participant.id)
+    user_dn = get_user_dn(participant)
     group_dn = None
     new_group_dn = None
     if participant.is_red:
@@ -1,10 +1,51 @@
 import csv
-from io import StringIO
+import time
+from collections import OrderedDict
 
 from django.contrib import admin
-from django.http import HttpResponse
+from django.contrib.admin import helpers
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.utils import six
+from django.utils import timezone
 
 import base.models as base_models
+from base import outbox
+
+
+class Echo(object):
+    """
+    A file-like object that hands back whatever is written to it, so csv.writer can produce rows for streaming.
+    """
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def _format_team(number, name):
+    if name is None:
+        return ""
+    return "Team {number}: {name}".format(number=number, name=name)
+
+
+# key: (header, fields, formatter)
+EXPORT_COLUMNS = OrderedDict([
+    ('name', ("Full Name", ('user__first_name', 'user__last_name'),
+              lambda first, last: " ".join((first, last)).strip())),
+    ('username', ("Username", ('user__username',), lambda value: value)),
+    ('email', ("Email", ('user__email',), lambda value: value)),
+    ('team', ("Team Name", ('team__number', 'team__name'), _format_team)),
+    ('captain', ("Captain", ('captain',), lambda value: value)),
+    ('checked_in', ("Checked In", ('checked_in',), lambda value: value)),
+    ('is_red', ("Red", ('is_red',), lambda value: value)),
+    ('is_green', ("Green", ('is_green',), lambda value: value)),
+    ('approved', ("R/G Approved", ('approved',), lambda value: value)),
+])
 
 
 class ParticipantAdmin(admin.ModelAdmin):
@@ -21,18 +62,21 @@ class ParticipantAdmin(admin.ModelAdmin):
         'mark_lft',
         'unmark_lft',
     ]
+    export_columns = list(EXPORT_COLUMNS.keys())
+
+    def _update(self, request, queryset, description, **fields):
+        start = time.time()
+        count = queryset.update_with_side_effects(**fields)
+        self.message_user(request, "{description} {count} participant{s} in {elapsed:.2f}s".format(
+            description=description, count=count, s='' if count == 1 else 's', elapsed=time.time() - start))
 
     def unmark_lft(self, request, queryset):
-        for participant in queryset:
-            participant.looking_for_team = False
-            participant.save()
+        self._update(request, queryset, "Unmarked LFT for", looking_for_team=False)
 
     unmark_lft.short_description = "Unmark LFT"
 
     def mark_lft(self, request, queryset):
-        for participant in queryset:
-            participant.looking_for_team = True
-            participant.save()
+        self._update(request, queryset, "Marked LFT for", looking_for_team=True)
 
     mark_lft.short_description = "Mark LFT"
 
@@ -42,20 +86,43 @@ class ParticipantAdmin(admin.ModelAdmin):
     participant_email.short_description = "Email"
 
     def export_csv(self, request, queryset):
-        si = StringIO()
-        cw = csv.writer(si)
-        cw.writerow(["Full Name", "Username", "Email", "Team Name", "Captain", "Checked In", "Red", "Green",
-                     "R/G Approved"])
-
-        for participant in queryset:
-            user = participant.user
-            # if not user.is_superuser and participant.team:
-            cw.writerow([user.get_full_name(), user.username, user.email, participant.team, participant.captain,
-                         participant.checked_in, participant.is_red, participant.is_green, participant.approved])
-
-        return HttpResponse(content=si.getvalue(), content_type="text/plain")
-
-    export_csv.short_name = "Export CSV of Participants"
+        """
+        Ask which columns to export, then stream the selected participants as CSV.
+        """
+        if 'export' not in request.POST:
+            return TemplateResponse(request, 'admin/export_csv.html', dict(
+                self.admin_site.each_context(request),
+                title="Export CSV of Participants",
+                opts=self.model._meta,
+                columns=[(key, column[0], key in self.export_columns) for key, column in EXPORT_COLUMNS.items()],
+                selected=request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+                select_across=request.POST.get('select_across', '0'),
+                action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+            ))
+
+        keys = request.POST.getlist('columns') or self.export_columns
+        columns = [EXPORT_COLUMNS[key] for key in keys if key in EXPORT_COLUMNS]
+
+        fields = []
+        for header, column_fields, formatter in columns:
+            fields.extend(column_fields)
+
+        def rows():
+            yield [header for header, column_fields, formatter in columns]
+            for values in queryset.values_list(*fields).iterator():
+                row = []
+                i = 0
+                for header, column_fields, formatter in columns:
+                    row.append(_csv_value(formatter(*values[i:i + len(column_fields)])))
+                    i += len(column_fields)
+                yield row
+
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse((writer.writerow(row) for row in rows()), content_type="text/csv")
+        response['Content-Disposition'] = 'attachment; filename="participants.csv"'
+        return response
+
+    export_csv.short_description = "Export CSV of Participants"
 
     def get_participant_emails(self, request, queryset):
         emails = []
@@ -68,14 +135,12 @@ class ParticipantAdmin(admin.ModelAdmin):
     get_participant_emails.short_description = "Get email list"
 
     def check_in(self, request, queryset):
-        for participant in queryset:
-            participant.check_in()
+        self._update(request, queryset, "Checked in", checked_in=True)
 
     check_in.short_description = "Check in"
 
     def undo_check_in(self, request, queryset):
-        for participant in queryset:
-            participant.undo_check_in()
+        self._update(request, queryset, "Undid check in for", checked_in=False)
 
     undo_check_in.short_description = "Undo check in"
 
@@ -93,16 +158,64 @@ class TeamAdmin(admin.ModelAdmin):
     ]
 
     def team_size(self, obj):
-        return len(obj.members())
+        return obj.member_count
+
+    team_size.admin_order_field = 'member_count'
 
 
 class ArchiveAdmin(admin.ModelAdmin):
     list_display = ('subject', 'audience')
     list_filter = ('audience',)
     search_fields = ('subject', 'content')
+    actions = ['resume']
+
+    def resume(self, request, queryset):
+        count = sum(outbox.resume(archived) for archived in queryset)
+        self.message_user(request, "Queued {} undelivered message(s) again".format(count))
+
+    resume.short_description = "Resend deferred messages"
+
+
+class EmailRecipientAdmin(admin.ModelAdmin):
+    list_display = ('address', 'email', 'status', 'attempts', 'sent_time')
+    list_filter = ('status',)
+    search_fields = ('address', 'email__subject')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        queryset.filter(status=base_models.EmailRecipient.FAILED).update(status=base_models.EmailRecipient.PENDING)
+
+    retry.short_description = "Resend failed messages"
+
+
+class CaptainNotificationAdmin(admin.ModelAdmin):
+    list_display = ('team', 'event', 'created', 'sent_time')
+    list_filter = ('event',)
+
+
+class CertificateDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('participant', 'competition_name', 'status', 'attempts', 'updated')
+    list_filter = ('status', 'competition_name')
+    search_fields = ('participant__user__username', 'participant__user__email')
+
+
+class LDAPJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'action', 'participant', 'status', 'attempts', 'run_after', 'updated')
+    list_filter = ('status', 'action')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        queryset.filter(status=base_models.LDAPJob.FAILED).update(status=base_models.LDAPJob.PENDING, attempts=0,
+                                                                  run_after=timezone.now())
+
+    retry.short_description = "Retry failed jobs"
 
 
 # Register your models here.
 admin.site.register(base_models.Participant, ParticipantAdmin)
 admin.site.register(base_models.Team, TeamAdmin)
 admin.site.register(base_models.ArchivedEmail, ArchiveAdmin)
+admin.site.register(base_models.EmailRecipient, EmailRecipientAdmin)
+admin.site.register(base_models.CaptainNotification, CaptainNotificationAdmin)
+admin.site.register(base_models.CertificateDelivery, CertificateDeliveryAdmin)
+admin.site.register(base_models.LDAPJob, LDAPJobAdmin)
@@ -21,60 +21,97 @@ class Breadcrumb(object):
             return format_html('<a href="{link}">{text}</a>', link=self.link, text=self.text)
 
 
+# Paths are memoized per process; paths with ids in them make these grow, so they are emptied at this size
+MAX_CACHED_PATHS = 2000
+
+# (urlconf, path): [(url, view class, args, kwargs)] for the path and its parents that resolve
+_resolved = {}
+# (urlconf, path): rendered html, for paths whose breadcrumbs are all static text
+_rendered = {}
+
+
 def render_breadcrumbs(path, context):
-    breadcrumbs = create_breadcrumbs(path, context)
+    path = path.split('?')[0]
+    key = (urlresolvers.get_urlconf(), path)
+    html = _rendered.get(key)
+    if html is not None:
+        return html
 
+    breadcrumbs, static = _build(path, context)
     html = ""
     for bread in breadcrumbs:
         html += bread.render()
+    if static:
+        _remember(_rendered, key, html)
     return html
 
 
 def create_breadcrumbs(path, context):
-    counter = 20
+    return _build(path.split('?')[0], context)[0]
+
+
+def _build(path, context):
+    """
+    Returns the breadcrumbs for a path and whether none of them depend on the context.
+    """
     breadcrumbs = []
+    static = True
+    for url, view, view_args, view_kwargs in _resolve_chain(path):
+        text = getattr(view, 'breadcrumb', None)
+        if callable(text):
+            static = False
+            text = text(context, *view_args, **view_kwargs)
+
+        if text:
+            breadcrumbs.append(Breadcrumb(url, text, url == path))
+
+    breadcrumbs.reverse()
+    return breadcrumbs, static
 
-    if '?' in path:
-        path = path.split('?')[0]
-    url = path
 
+def _resolve_chain(path):
+    """
+    The views of a path and each of its parent urls, from the path up to /.
+    """
+    key = (urlresolvers.get_urlconf(), path)
+    chain = _resolved.get(key)
+    if chain is not None:
+        return chain
+
+    chain = []
+    counter = 20
+    url = path
     while True:
         counter -= 1
         if counter < 1:
             break
 
         # Try to resolve the url to a view
-        view = None
         try:
-            # Stack Overview answer:
-            # http://stackoverflow.com/questions/5749075/django-get-generic-view-class-from-url-name
             resolver_match = urlresolvers.resolve(url)
-            func = resolver_match.func
-            view_args = resolver_match.args
-            view_kwargs = resolver_match.kwargs
-            module = func.__module__
-            view_name = func.__name__
-            view = get_class('{0}.{1}'.format(module, view_name))
         # Couldn't resolve the url
         except http.Http404 as e:
             pass
-
         # We have a valid view
         else:
-            text = getattr(view, 'breadcrumb', None)
-            if callable(text):
-                text = text(context, *view_args, **view_kwargs)
-
-            if text:
-                breadcrumbs.append(Breadcrumb(url, text, url == path))
+            func = resolver_match.func
+            # as_view() records the class; fall back to importing it for other views
+            view = getattr(func, 'view_class', None) or get_class('{0}.{1}'.format(func.__module__, func.__name__))
+            chain.append((url, view, resolver_match.args, resolver_match.kwargs))
 
         if url == '/':
             break
 
         url = urljoin(url, '..')
 
-    breadcrumbs.reverse()
-    return breadcrumbs
+    _remember(_resolved, key, chain)
+    return chain
+
+
+def _remember(cache, key, value):
+    if len(cache) >= MAX_CACHED_PATHS:
+        cache.clear()
+    cache[key] = value
 
 
 # This is fairly janky.  Found it at stack overflow.
@@ -0,0 +1,28 @@
+import subprocess
+
+from fdfgen import forge_fdf
+
+# Form fields of the certificate template
+FIELDS = ('participant_name', 'cdc_name', 'issue_date')
+
+
+class PdftkRenderer(object):
+    """
+    Fills and flattens the certificate form with pdftk, piping the FDF in and the PDF out, so no
+    temporary files are written.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def render(self, fields):
+        process = subprocess.Popen(['pdftk', self.template, 'fill_form', '-', 'output', '-', 'flatten'],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate(forge_fdf("", list(fields), [], [], []))
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, 'pdftk', error)
+        return output
+
+
+def certificate_fields(participant_name, cdc_name, issue_date):
+    return list(zip(FIELDS, (participant_name, cdc_name, issue_date)))
@@ -1,3 +1,8 @@
+import string
+
+from django.conf import settings
+from django.utils import six
+
 ACCOUNT_CREATED = """Hi there {fname} {lname},
 
 Your ISEAGE CDC account has been successfully created!
@@ -41,6 +46,17 @@ Make sure you change your password right away.
 If you have questions, email CDC support at {support}.
 """
 
+SIGNUP_FAILED = """Hi there {fname} {lname},
+
+We were unable to create your ISEAGE CDC account:
+
+{reason}
+
+Please sign up again at https://signup.iseage.org/signup/
+
+If you have questions, email CDC support at {support}.
+"""
+
 PASSWORD_UPDATED = """Hi there {fname} {lname},
 
 Your password has been successfully updated.
@@ -135,6 +151,17 @@ STEPPED_DOWN = """Hi there captains,
 If you have questions, email CDC support at {support}
 """
 
+CAPTAIN_DIGEST = """Hi there {fname} {lname},
+
+Here is what has happened on your team, {team}, recently:
+
+{events}
+
+Visit https://signup.iseage.org/dashboard/manage_team/ to manage your team.
+
+If you have questions, email CDC support at {support}
+"""
+
 TEAM_DISBANDED = """Hi there members,
 
 Your team, {team}, has been disbanded.
@@ -150,3 +177,124 @@ Thank you for participating in the CDC. Your certificate is attached to this ema
 
 If you have questions, email CDC support at {support}
 """
+
+# Used to list a team's captains in JOIN_REQUEST_APPROVED
+CAPTAIN_LINE = "{fname} {lname}  \t{email}\n"
+
+
+##########
+# Registry
+##########
+_formatter = string.Formatter()
+
+
+class CompiledFormat(object):
+    """
+    A str.format template parsed once. Values that are the same for every email (bound) are filled in
+    at compile time, so rendering only joins the literal text with the remaining values.
+    """
+
+    def __init__(self, template, **bound):
+        self.template = template
+        self.parts = []
+        literal = ""
+        for text, field, spec, conversion in _formatter.parse(template):
+            literal += text
+            if field is None:
+                continue
+            if field in bound:
+                literal += self._format(bound[field], spec, conversion)
+                continue
+            self.parts.append((literal, field, spec, conversion))
+            literal = ""
+        self.tail = literal
+
+    @staticmethod
+    def _format(value, spec, conversion):
+        if conversion:
+            value = _formatter.convert_field(value, conversion)
+        if spec or not isinstance(value, six.string_types):
+            value = format(value, spec)
+        return value
+
+    def format(self, **values):
+        output = []
+        for literal, field, spec, conversion in self.parts:
+            output.append(literal)
+            output.append(self._format(values[field], spec, conversion))
+        output.append(self.tail)
+        return "".join(output)
+
+    def format_many(self, recipients, **shared):
+        """
+        Render the template once per dict of values in recipients, with shared filled in for all of them.
+        """
+        rendered = []
+        for values in recipients:
+            merged = dict(shared)
+            merged.update(values)
+            rendered.append(self.format(**merged))
+        return rendered
+
+
+class EmailTemplate(object):
+    def __init__(self, subject, body):
+        bound = {'support': settings.SUPPORT_EMAIL}
+        self.subject = CompiledFormat(subject, **bound)
+        self.body = CompiledFormat(body, **bound)
+
+    def render(self, **values):
+        """
+        Returns the (subject, body) for one email.
+        """
+        return self.subject.format(**values), self.body.format(**values)
+
+    def render_many(self, recipients, **shared):
+        """
+        Returns a (subject, body) for every dict of values in recipients.
+        """
+        return list(zip(self.subject.format_many(recipients, **shared), self.body.format_many(recipients, **shared)))
+
+
+TEMPLATES = {
+    'account_created': EmailTemplate('Your ISEAGE CDC account', ACCOUNT_CREATED),
+    'account_created_red': EmailTemplate('Your ISEAGE CDC account', ACCOUNT_CREATED_RED),
+    'account_created_green': EmailTemplate('Your ISEAGE CDC account', ACCOUNT_CREATED_GREEN),
+    'signup_failed': EmailTemplate('Your ISEAGE CDC account', SIGNUP_FAILED),
+    'password_updated': EmailTemplate('ISEAGE CDC Support: Password successfully updated', PASSWORD_UPDATED),
+    'password_reset': EmailTemplate('ISEAGE CDC Support: Your password has been reset', PASSWORD_RESET),
+    'team_created': EmailTemplate('ISEAGE CDC Support: Team Created', TEAM_CREATED),
+    'join_request_approved': EmailTemplate('ISEAGE CDC Support: You have been added to a team', JOIN_REQUEST_APPROVED),
+    'captain_request_approved': EmailTemplate('ISEAGE CDC Support: You have been promoted to captain',
+                                              CAPTAIN_REQUEST_APPROVED),
+    'join_request_submitted': EmailTemplate('ISEAGE CDC Support: Someone has requested to join your team',
+                                            JOIN_REQUEST_SUBMITTED),
+    'member_joined': EmailTemplate('ISEAGE CDC Support: Someone has joined your team', MEMBER_JOINED),
+    'captain_request_submitted': EmailTemplate('ISEAGE CDC Support: Someone has requested to become a captain of your team',
+                                               CAPTAIN_REQUEST_SUBMITTED),
+    'left_team': EmailTemplate('ISEAGE CDC Support: A member has left your team', LEFT_TEAM),
+    'stepped_down': EmailTemplate('ISEAGE CDC Support: A member has stepped down as captain', STEPPED_DOWN),
+    'captain_digest': EmailTemplate('ISEAGE CDC Support: Updates for your team', CAPTAIN_DIGEST),
+    'team_disbanded': EmailTemplate('ISEAGE CDC Support: Your team has been disbanded', TEAM_DISBANDED),
+    'certificate': EmailTemplate('[CDC] {cdc_name} Certificate', CERTIFICATE),
+    'participant_email': EmailTemplate('[{prefix}] {subject}', '{content}'),
+}
+
+_captain_line = CompiledFormat(CAPTAIN_LINE)
+
+
+def render(name, **values):
+    return TEMPLATES[name].render(**values)
+
+
+def render_many(name, recipients, **shared):
+    return TEMPLATES[name].render_many(recipients, **shared)
+
+
+def captain_list(captains):
+    """
+    The lines listing captains (Participants with their users loaded) in JOIN_REQUEST_APPROVED.
+    """
+    return "".join(_captain_line.format_many(
+        dict(fname=captain.user.first_name, lname=captain.user.last_name, email=captain.user.email)
+        for captain in captains))
@@ -0,0 +1,152 @@
+from django import forms
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils import six
+from django.utils.safestring import mark_safe
+
+from base.email_templates import CompiledFormat
+
+FIELD = '<div id="div_{name}" class="{classes}"><label class="col-sm-2 control-label" for="id_{name}">{label}</label><div class="col-sm-8">{widget}<span class="help-block">{error}</span></div></div>'
+CHECKBOX_FIELD = '<div id="div_{name}" class="{classes}"><label class="col-sm-9 col-sm-offset-1 checkbox">{widget} {label}</label><span class="help-block">{error}</span></div>'
+RADIO_FIELD = '<div id="div_{name}" class="{classes}"><label class="col-sm-9 col-sm-offset-1 radio">{widget}</label><span class="help-block">{error}</span></div>'
+HIDDEN_FIELD = '<div class="hidden">{widget}</div>'
+
+REQUIRED = '<span class="required-indicator" title="This Field is Required">*</span>'
+NOT_REQUIRED = '<span class="required-indicator">&nbsp;</span>'
+
+# (form class, field name, label): FieldRow
+_rows = {}
+# (form class, field names, in_widget, show_legend): FormLayout
+_layouts = {}
+_templates = {}
+
+
+class FieldRow(object):
+    """
+    The bootstrap horizontal row of one field. Everything but the bound value and errors is filled in
+    when the row is compiled.
+    """
+
+    def __init__(self, bound, label=None):
+        self.hidden = bound.is_hidden
+        if self.hidden:
+            self.template = CompiledFormat(HIDDEN_FIELD)
+            return
+
+        widget = bound.field.widget
+        required = REQUIRED if bound.field.required else NOT_REQUIRED
+        field_label = label or bound.label
+        if not field_label.strip():
+            final_label = ' '
+        elif isinstance(widget, forms.widgets.CheckboxInput):
+            final_label = '{label}{required}'.format(label=field_label, required=required)
+        else:
+            final_label = '{label}:{required}'.format(label=field_label, required=required)
+
+        if isinstance(widget, forms.widgets.CheckboxInput):
+            template = CHECKBOX_FIELD
+        elif isinstance(widget, forms.widgets.RadioSelect):
+            template = RADIO_FIELD
+        else:
+            template = FIELD
+        self.template = CompiledFormat(template, name=bound.name, label=final_label)
+
+    def render(self, bound):
+        if self.hidden:
+            return self.template.format(widget=six.text_type(bound))
+        errors = bound.errors
+        return self.template.format(classes='form-group error' if errors else 'form-group',
+                                    widget=six.text_type(bound), error=six.text_type(errors))
+
+
+class FormLayout(object):
+    """
+    The fieldsets (from Meta.fieldsets) or plain field list of a form class, compiled to a list of
+    literal html and field rows. Rendering a form only renders its widgets and errors.
+
+    Compiled from the first form rendered, so labels, required flags and widgets must not change
+    between instances of the same form class.
+    """
+
+    def __init__(self, form, in_widget=False, show_legend=True):
+        self.parts = []
+        self._literal = []
+        meta = getattr(form, 'Meta', None)
+
+        if hasattr(meta, 'fieldsets'):
+            if in_widget:
+                self._add('<div class="fieldset-container">')
+            for fieldset in meta.fieldsets:
+                self._add('<fieldset id="{id}">'.format(id=fieldset.get('id', '')))
+                if show_legend:
+                    self._add("<legend>{legend}</legend>".format(legend=fieldset.get('legend', '')))
+                title = fieldset.get('title', '')
+                if title:
+                    self._add('<p class="title">{title}</p>'.format(title=title))
+                self._add('<div>')
+                self._add_fields(form, fieldset.get('fields', list(form.fields.keys())))
+                self._add('</div></fieldset>')
+            if in_widget:
+                self._add('</div>')
+        else:
+            exclude_names = getattr(meta, 'excludes', [])
+            if in_widget:
+                self._add('<div class="fieldset-container">')
+            self._add('<fieldset><div>')
+            self._add_fields(form, [name for name in form.fields.keys() if name not in exclude_names])
+            self._add('</div></fieldset>')
+            if in_widget:
+                self._add('</div>')
+        self._flush(None, None)
+
+    def _add(self, html):
+        self._literal.append(html)
+
+    def _add_fields(self, form, field_names):
+        for name in field_names:
+            if name in form.fields:
+                self._flush(name, FieldRow(form[name]))
+
+    def _flush(self, name, row):
+        self.parts.append(("".join(self._literal), name, row))
+        self._literal = []
+
+    def render(self, form):
+        output = []
+        for literal, name, row in self.parts:
+            output.append(literal)
+            if row is not None:
+                output.append(row.render(form[name]))
+        return "".join(output)
+
+
+def render_field(bound, label=None):
+    key = (type(bound.form), bound.name, label)
+    row = _rows.get(key)
+    if row is None:
+        row = _rows[key] = FieldRow(bound, label)
+    return mark_safe(row.render(bound))
+
+
+def get_layout(form, in_widget=False, show_legend=True):
+    key = (type(form), tuple(form.fields.keys()), in_widget, show_legend)
+    layout = _layouts.get(key)
+    if layout is None:
+        layout = _layouts[key] = FormLayout(form, in_widget, show_legend)
+    return layout
+
+
+def render_form(form, errors="", in_widget=False, show_legend=True):
+    return mark_safe(errors + get_layout(form, in_widget, show_legend).render(form))
+
+
+def get_widget_template(name):
+    """
+    The template loaders aren't cached, so keep the templates the form tags render on every page.
+    """
+    if settings.DEBUG:
+        return get_template(name)
+    template = _templates.get(name)
+    if template is None:
+        template = _templates[name] = get_template(name)
+    return template
@@ -0,0 +1,156 @@
+import datetime
+import json
+import logging
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+import smtplib
+
+import base
+from base import actions, email_templates, models
+
+
+##########
+# Handlers
+##########
+def _signup_failed(error, username, fname, lname, email, color):
+    # The applicant is long gone by the time the worker finds out, so tell them by email
+    if isinstance(error, base.UsernameAlreadyExistsError):
+        reason = "The username {username} is already taken.".format(username=username)
+    else:
+        reason = "There is already an account named {fname} {lname}. " \
+                 "Try including your middle initial or middle name.".format(fname=fname, lname=lname)
+    subject, email_body = email_templates.render('signup_failed', fname=fname, lname=lname, reason=reason)
+    try:
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, [email])
+    except smtplib.SMTPException:
+        logging.warning("Failed to send email to {email}:\n{body}".format(email=email, body=email_body))
+
+
+HANDLERS = {
+    'add_user_to_group': actions.add_user_to_group,
+    'remove_user_from_group': actions.remove_user_from_group,
+    'modify_group_members': actions.modify_group_members,
+    'create_account': actions.create_user_account,
+}
+
+# Called with the exception and the job arguments when a job hits a permanent error
+ON_PERMANENT_ERROR = {
+    'create_account': _signup_failed,
+}
+
+# Errors that will never succeed on a retry
+PERMANENT_ERRORS = (base.UsernameAlreadyExistsError, base.DuplicateName)
+
+
+##########
+# Queue
+##########
+def job_key(action, arguments):
+    return "{action}:{arguments}".format(action=action, arguments=json.dumps(arguments, sort_keys=True))[:255]
+
+
+def enqueue(action, participant=None, **arguments):
+    """
+    Queue an LDAP operation for the ldapworker command.
+
+    If LDAP_ASYNC is off the operation runs immediately and its result is returned instead.
+    """
+    if not settings.LDAP_ASYNC:
+        return HANDLERS[action](**arguments)
+
+    key = job_key(action, arguments)
+    unfinished = models.LDAPJob.objects.filter(status__in=(models.LDAPJob.PENDING, models.LDAPJob.RUNNING))
+    if participant is not None:
+        unfinished = unfinished.filter(participant=participant)
+    else:
+        unfinished = unfinished.filter(key=key)
+
+    # Only skip the job if the newest unfinished one is identical, otherwise an add/remove/add
+    # sequence would collapse into add/remove
+    latest = unfinished.order_by('-id').first()
+    if latest is not None and latest.key == key:
+        return latest
+
+    return models.LDAPJob.objects.create(action=action, arguments=json.dumps(arguments), key=key,
+                                         participant=participant)
+
+
+def requeue_stalled():
+    """
+    Put jobs that were running when a worker died back in the queue.
+    """
+    return models.LDAPJob.objects.filter(status=models.LDAPJob.RUNNING).update(status=models.LDAPJob.PENDING)
+
+
+def claim_next():
+    """
+    Claim the oldest job that is due.
+
+    Jobs for a participant run strictly in the order they were queued, so that a retried group change
+    can never overtake a later one for the same participant. A job waiting out its backoff only holds
+    up that participant's later jobs.
+    """
+    now = timezone.now()
+    earlier = models.LDAPJob.objects.filter(participant=OuterRef('participant'), id__lt=OuterRef('id'),
+                                            status__in=(models.LDAPJob.PENDING, models.LDAPJob.RUNNING))
+    with transaction.atomic():
+        job = models.LDAPJob.objects.select_for_update() \
+            .filter(status=models.LDAPJob.PENDING, run_after__lte=now) \
+            .annotate(waiting=Exists(earlier)).filter(waiting=False).order_by('id').first()
+        if job is None:
+            return None
+        job.status = models.LDAPJob.RUNNING
+        job.attempts += 1
+        job.save(update_fields=['status', 'attempts', 'updated'])
+    return job
+
+
+def run_job(job):
+    error = ""
+    arguments = json.loads(job.arguments)
+    try:
+        result = HANDLERS[job.action](**arguments)
+    except PERMANENT_ERRORS as e:
+        job.status = models.LDAPJob.FAILED
+        job.last_error = repr(e)
+        job.save(update_fields=['status', 'last_error', 'updated'])
+        if job.action in ON_PERMANENT_ERROR:
+            ON_PERMANENT_ERROR[job.action](e, **arguments)
+        return job
+    except Exception as e:
+        logging.exception("LDAP job {id} ({action}) raised".format(id=job.id, action=job.action))
+        result = False
+        error = repr(e)
+
+    if result is not False:
+        job.status = models.LDAPJob.DONE
+    elif job.attempts < settings.LDAP_JOB_MAX_ATTEMPTS:
+        backoff = settings.LDAP_JOB_BACKOFF * 2 ** (job.attempts - 1)
+        job.status = models.LDAPJob.PENDING
+        job.run_after = timezone.now() + datetime.timedelta(seconds=backoff)
+    else:
+        job.status = models.LDAPJob.FAILED
+    job.last_error = error or ("" if result is not False else "Operation failed, see the LDAP debug log")
+    job.save(update_fields=['status', 'run_after', 'last_error', 'updated'])
+    return job
+
+
+def run_pending():
+    """
+    Run every job that is currently due. Returns the number of jobs run.
+    """
+    count = 0
+    job = claim_next()
+    while job is not None:
+        run_job(job)
+        count += 1
+        job = claim_next()
+    return count
+
+
+def get_participant_jobs(participant):
+    return models.LDAPJob.objects.filter(participant=participant).exclude(status=models.LDAPJob.DONE)
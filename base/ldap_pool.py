@@ -0,0 +1,91 @@
+import threading
+import time
+
+import ldap
+
+
+class AdminConnectionPool(object):
+    """
+    A per-process pool of LDAP connections that are already bound as the admin account.
+
+    Connections are handed out by acquire() and given back with release(). Idle connections
+    are health-checked before reuse once they have been sitting for longer than check_interval
+    seconds, and the whole pool is rebound whenever the admin credentials change.
+    """
+
+    def __init__(self, bind, credentials, max_size=4, check_interval=60):
+        """
+        bind is a callable returning a freshly bound connection (or None), credentials is a
+        callable returning the (dn, password) pair the next bind would use.
+        """
+        self.bind = bind
+        self.credentials = credentials
+        self.max_size = max_size
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._borrowed = {}
+        self._bound_as = None
+
+    def acquire(self):
+        credentials = self.credentials()
+        with self._lock:
+            if credentials != self._bound_as:
+                stale = self._idle
+                self._idle = []
+                self._bound_as = credentials
+            else:
+                stale = []
+        for connection, last_used in stale:
+            self._unbind(connection)
+
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            if time.time() - last_used < self.check_interval or self._is_alive(connection):
+                return self._lend(connection, credentials)
+            self._unbind(connection)
+
+        connection = self.bind()
+        if connection:
+            return self._lend(connection, credentials)
+        return None
+
+    def release(self, connection, discard=False):
+        with self._lock:
+            credentials = self._borrowed.pop(id(connection), None)
+            if not discard and credentials == self._bound_as and len(self._idle) < self.max_size:
+                self._idle.append((connection, time.time()))
+                return
+        self._unbind(connection)
+
+    def clear(self):
+        with self._lock:
+            stale = self._idle
+            self._idle = []
+            self._bound_as = None
+        for connection, last_used in stale:
+            self._unbind(connection)
+
+    def _lend(self, connection, credentials):
+        with self._lock:
+            self._borrowed[id(connection)] = credentials
+        return connection
+
+    @staticmethod
+    def _is_alive(connection):
+        try:
+            connection.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    @staticmethod
+    def _unbind(connection):
+        try:
+            connection.unbind_s()
+        except ldap.LDAPError:
+            pass
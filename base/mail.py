@@ -0,0 +1,125 @@
+import smtplib
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+
+class TokenBucket(object):
+    """
+    Allows rate messages per second on average with bursts of up to burst messages. Can be shared
+    between threads to put one budget on several connections.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Wait until a token is available and use it.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_bucket(per_minute=None, burst=None):
+    """
+    Build a TokenBucket from a messages per minute budget, defaulting to the EMAIL_RATE settings.
+    Returns None when the rate is unlimited.
+    """
+    per_minute = settings.EMAIL_RATE_PER_MINUTE if per_minute is None else per_minute
+    burst = settings.EMAIL_RATE_BURST if burst is None else burst
+    if not per_minute:
+        return None
+    return TokenBucket(per_minute / 60.0, burst)
+
+
+class MailDispatcher(object):
+    """
+    Sends messages over one reused SMTP connection within a rate budget and keeps count of how it went.
+
+        with MailDispatcher() as dispatcher:
+            dispatcher.send(message)
+        print(dispatcher.report())
+
+    Pass a shared bucket to have several dispatchers (e.g. one per thread) share one budget.
+    """
+    ERRORS = (smtplib.SMTPException, socket.error)
+
+    def __init__(self, per_minute=None, burst=None, bucket=None, connection=None):
+        self.bucket = bucket if bucket is not None else make_bucket(per_minute, burst)
+        self.connection = connection or get_connection()
+        self.sent = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        if self.started is None:
+            self.started = time.time()
+
+    def open(self):
+        """
+        Open the SMTP connection if it isn't open yet. Every message goes over it until it is closed.
+        """
+        self.start()
+        self.connection.open()
+
+    def close(self):
+        self.finished = time.time()
+        self.connection.close()
+
+    def send(self, message):
+        """
+        Send one EmailMessage, opening the connection first if needed. SMTP errors (including failing to
+        connect) are raised after the connection is closed, so the next message reconnects.
+        """
+        if self.bucket is not None:
+            self.bucket.take()
+        try:
+            self.open()
+            message.connection = self.connection
+            message.send(fail_silently=False)
+        except self.ERRORS:
+            self.failed += 1
+            self.connection.close()
+            raise
+        self.sent += 1
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """
+        Messages sent per minute.
+        """
+        return self.sent * 60 / self.elapsed if self.elapsed else 0
+
+    def report(self):
+        return "Sent {sent} message(s), {failed} failed in {elapsed:.1f}s ({rate:.1f}/min)".format(
+            sent=self.sent, failed=self.failed, elapsed=self.elapsed, rate=self.throughput)
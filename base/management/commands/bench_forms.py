@@ -0,0 +1,56 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.template import Context
+from django.template.loader import get_template
+
+from base import form_layouts, forms, models
+from base.templatetags import tt_web
+
+FORMS = {
+    'signup': lambda data: forms.SignupForm(data),
+    'global_settings': lambda data: forms.GlobalSettingsForm(data, instance=models.GlobalSettings()),
+}
+
+# Leaves most fields empty, so the bound forms render errors too
+BOUND_DATA = {'email': 'not-an-email', 'number_of_teams': 'ten'}
+
+
+class Command(BaseCommand):
+    help = 'Time rendering the signup and global settings forms with and without compiled layouts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--renders', default=500, type=int, help='Renders per batch')
+        parser.add_argument('--repeat', default=5, type=int, help='Batches to time, the best one is reported')
+
+    def handle(self, *args, **options):
+        count = options['renders']
+        self.stdout.write("Best of {} batches of {} renders, ms per render".format(options['repeat'], count),
+                          self.style.MIGRATE_HEADING)
+        self.stdout.write("{:<26} {:>12} {:>12} {:>12} {:>12}".format(
+            "form", "layout", "compiled", "widget", "memoized"))
+
+        for name in sorted(FORMS.keys()):
+            for bound in (False, True):
+                form = FORMS[name](BOUND_DATA if bound else None)
+                form.is_valid()
+
+                def layout():
+                    # Compile the layout again for every render, like the tags did before
+                    form_layouts.FormLayout(form, in_widget=True).render(form)
+
+                def compiled():
+                    return form_layouts.get_layout(form, in_widget=True).render(form)
+
+                def widget():
+                    # Load and parse the widget templates every render, as the uncached loaders do
+                    get_template('includes/form_controlbox.html').render({})
+                    get_template('includes/widget_box.html').render({'widget_content': compiled()})
+
+                def memoized():
+                    tt_web.render_form_widget(Context(), form)
+
+                times = [min(timeit.repeat(fn, number=count, repeat=options['repeat'])) * 1000.0 / count
+                         for fn in (layout, compiled, widget, memoized)]
+                self.stdout.write("{:<26} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                    "{} ({})".format(name, "bound" if bound else "unbound"), *times))
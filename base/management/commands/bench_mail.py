@@ -0,0 +1,165 @@
+import datetime
+import math
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+from django.utils import six
+
+from base import actions, models, smtp_sink
+
+PATHS = ('email_participants', 'certificates', 'actions')
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(int(math.ceil(len(values) * percent / 100.0)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = 'Measure the mail paths against a local SMTP sink. The synthetic participants are rolled back afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', default=200, type=int, help='Synthetic participants to create')
+        parser.add_argument('--team-size', default=4, type=int, help='Synthetic participants per synthetic team')
+        parser.add_argument('--paths', default=",".join(PATHS), help='Comma separated paths to run, from ' + ", ".join(PATHS))
+        parser.add_argument('--certificate', default=None,
+                            help='Certificate template for the certificates path, if GlobalSettings has none')
+        parser.add_argument('--jobs', default=2, type=int, help='--jobs for the certificates path')
+
+    def handle(self, *args, **options):
+        paths = [path for path in options['paths'].split(',') if path]
+        for path in paths:
+            if path not in PATHS:
+                raise CommandError("Unknown path {}, choose from {}".format(path, ", ".join(PATHS)))
+
+        self.sink = smtp_sink.SMTPSink()
+        self.sink.start()
+        self.results = []
+        self.created_participants = []
+        self.created_teams = []
+
+        mail_settings = dict(
+            EMAIL_BACKEND='base.smtp_sink.TimedEmailBackend',
+            EMAIL_HOST=self.sink.host,
+            EMAIL_PORT=self.sink.port,
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            EMAIL_RATE_PER_MINUTE=0,
+            # Outbox threads could not see the uncommitted synthetic rows, so send from this thread
+            EMAIL_OUTBOX_ASYNC=False,
+            EMAIL_OUTBOX_WORKERS=1,
+            CAPTAIN_DIGEST_WINDOW=0,
+            # Never talk to AD, the group changes are only queued and rolled back
+            LDAP_ASYNC=True,
+        )
+        try:
+            with override_settings(**mail_settings):
+                with transaction.atomic():
+                    self.create_synthetic(options['participants'], options['team_size'])
+                    for path in paths:
+                        getattr(self, 'bench_' + path)(options)
+                    raise Rollback()
+        except Rollback:
+            pass
+        finally:
+            self.sink.stop()
+            # Cached values may refer to rows that no longer exist
+            actions.forget_user_dns(self.created_participants)
+            for team_id in self.created_teams:
+                actions.forget_group_dn(team_id)
+            actions.reset_global_settings_object()
+
+        self.stdout.write("{:<34} {:>8} {:>9} {:>9} {:>9}".format("path", "messages", "seconds", "msg/s", "p95 ms"),
+                          self.style.MIGRATE_HEADING)
+        for name, messages, elapsed, latencies in self.results:
+            self.stdout.write("{:<34} {:>8} {:>9.2f} {:>9.1f} {:>9.1f}".format(
+                name, messages, elapsed, messages / elapsed if elapsed else 0, percentile(latencies, 95) * 1000))
+
+    def measure(self, name, func):
+        smtp_sink.TimedEmailBackend.reset()
+        before = self.sink.count
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        self.results.append((name, self.sink.count - before, elapsed, list(smtp_sink.TimedEmailBackend.latencies)))
+
+    def create_synthetic(self, count, team_size):
+        self.stdout.write("Creating {} synthetic participants".format(count))
+        self.sender = User.objects.create(username='signup-bench-sender', email='sender@bench.invalid')
+        self.free = []
+        for i in range(count):
+            user = User.objects.create(username='signup-bench-{}'.format(i), first_name='Bench', last_name=six.text_type(i),
+                                       email='bench{}@bench.invalid'.format(i))
+            self.free.append(user.participant)
+        self.created_participants = [participant.pk for participant in self.free] + [self.sender.participant.pk]
+
+        # Every team gets one captain from the participants, the rest stay free for the actions path
+        self.teams = []
+        for i in range(max(count // team_size, 1)):
+            if not self.free:
+                break
+            team = models.Team.objects.create(name='Bench Team {}'.format(i), number=100000 + i)
+            captain = self.free.pop()
+            captain.team = team
+            captain.captain = True
+            captain.checked_in = True
+            captain.save()
+            self.teams.append(team)
+        self.created_teams = [team.pk for team in self.teams]
+
+    def bench_email_participants(self, options):
+        self.measure('email_participants', lambda: actions.email_participants(
+            'Benchmark', 'Benchmark email', 'all', self.sender))
+
+    def bench_certificates(self, options):
+        gs = actions.get_global_settings_object()
+        if options['certificate']:
+            gs.certificate_template.name = os.path.abspath(options['certificate'])
+        if not gs.certificate_template:
+            self.stderr.write("Skipping certificates: no certificate template, pass --certificate")
+            return
+        if not gs.competition_date:
+            gs.competition_date = datetime.date.today()
+        gs.save()
+
+        models.Participant.objects.filter(pk__in=self.created_participants).update(checked_in=True)
+        self.measure('certificates', lambda: call_command('certificates', jobs=options['jobs'], rate=0,
+                                                          stdout=six.StringIO(), stderr=six.StringIO()))
+
+    def bench_actions(self, options):
+        members = list(self.free)
+        if not members:
+            self.stderr.write("Skipping actions: no participants left after picking captains")
+            return
+
+        def team_of(i):
+            return self.teams[i % len(self.teams)]
+
+        def each(func):
+            return lambda: [func(i, participant) for i, participant in enumerate(members)]
+
+        self.measure('actions.submit_join_request', each(
+            lambda i, participant: actions.submit_join_request(participant.pk, team_of(i).pk)))
+        self.measure('actions.join_team', each(
+            lambda i, participant: actions.join_team(participant.pk, team_of(i).pk)))
+        self.measure('actions.sumbit_captain_request', each(
+            lambda i, participant: actions.sumbit_captain_request(participant.pk)))
+        self.measure('actions.promote_to_captain', each(
+            lambda i, participant: actions.promote_to_captain(participant.pk)))
+        self.measure('actions.demote_captain', each(
+            lambda i, participant: actions.demote_captain(participant.pk)))
+        self.measure('actions.leave_team', each(
+            lambda i, participant: actions.leave_team(participant.pk)))
@@ -0,0 +1,73 @@
+from importlib import import_module
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+    'django.contrib.sessions.backends.cache',
+)
+
+# name: SESSION_SAVE_EVERY_REQUEST
+POLICIES = (
+    ('every request', True),
+    ('on change', False),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Count the session writes made by a logged in user for each session engine and write policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', default=100, type=int, help='Requests per engine and policy')
+        parser.add_argument('--paths', default='/,/dashboard/', help='Comma separated paths to request in turn')
+
+    def handle(self, *args, **options):
+        paths = [path for path in options['paths'].split(',') if path]
+        self.stdout.write("{:<45} {:<14} {:>8} {:>9} {:>10} {:>13}".format(
+            "engine", "policy", "requests", "saves", "db writes", "saves/request"), self.style.MIGRATE_HEADING)
+
+        try:
+            with transaction.atomic():
+                user = User.objects.create(username='signup-bench-sessions', email='sessions@bench.invalid')
+                for engine in ENGINES:
+                    for name, every_request in POLICIES:
+                        saves, writes = self.run(engine, every_request, user, paths, options['requests'])
+                        self.stdout.write("{:<45} {:<14} {:>8} {:>9} {:>10} {:>13.2f}".format(
+                            engine, name, options['requests'], saves, writes, float(saves) / options['requests']))
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, engine, every_request, user, paths, count):
+        store = import_module(engine).SessionStore
+        saves = [0]
+        save = store.save
+
+        def counting_save(session, *args, **kwargs):
+            saves[0] += 1
+            return save(session, *args, **kwargs)
+
+        with override_settings(SESSION_ENGINE=engine, SESSION_SAVE_EVERY_REQUEST=every_request,
+                               ALLOWED_HOSTS=['testserver'], SESSION_COOKIE_SECURE=False):
+            client = Client()
+            client.force_login(user)
+            store.save = counting_save
+            try:
+                with CaptureQueriesContext(connection) as queries:
+                    for i in range(count):
+                        client.get(paths[i % len(paths)])
+            finally:
+                store.save = save
+
+        writes = [query for query in queries.captured_queries if 'django_session' in query['sql']
+                  and query['sql'].lstrip().upper().startswith(('INSERT', 'UPDATE'))]
+        return saves[0], len(writes)
@@ -1,43 +1,70 @@
+import datetime
 import time
 from django.conf import settings
-from django.core import mail
 from django.core.mail.message import EmailMessage
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import F
+from django.utils import dateparse, timezone
 from django.utils.text import slugify
-from fdfgen import forge_fdf
-import subprocess
+import multiprocessing
 import os
-import tempfile
-import shutil
 
+from base import certificates as base_certificates
+from base import mail as base_mail
 from base import models as base_models
 from base import actions as base_actions
-from base.email_templates import CERTIFICATE
+from base import email_templates
 
 
-BATCH_SIZE = 10
-BATCH_TIMER = 20
+PROGRESS_EVERY = 25
+
+
+# The renderer of a worker process
+_renderer = None
+
+
+def start_renderer(cert_file):
+    global _renderer
+    _renderer = base_certificates.PdftkRenderer(cert_file)
+
+
+def render_certificate(job):
+    """
+    Fill the certificate template for one participant in a worker process. Returns the username
+    with the PDF contents, or with the error if rendering failed, so one bad certificate doesn't
+    stop the pool.
+    """
+    username, fields = job
+    try:
+        return username, _renderer.render(fields), None
+    except Exception as e:
+        return username, None, repr(e)
 
 
 class Command(BaseCommand):
-    help = 'Send participation certificates to checked-in participants'
+    help = 'Send participation certificates to checked-in participants, skipping those who already got one'
 
     def add_arguments(self, parser):
         parser.add_argument('-d', '--dry-run', default=False, action='store_true')
-        parser.add_argument('-n', '--no-clean', default=False, action='store_true', help="Don't clean generated certificates")
-        parser.add_argument('-b', '--batch', default=BATCH_SIZE)
+        parser.add_argument('-o', '--output-dir', default=None, help='Also save the generated certificates in this directory')
+        parser.add_argument('-r', '--rate', default=settings.EMAIL_RATE_PER_MINUTE, type=float,
+                            help='Messages to send per minute, 0 for no limit')
+        parser.add_argument('-b', '--burst', default=settings.EMAIL_RATE_BURST, type=int,
+                            help='Messages that can be sent back to back before the rate applies')
         parser.add_argument('--names', default=False, action='store_true', help='Print names of participants as the emails are generated')
         parser.add_argument('--resend', default=None, help='Resend the certificate for a specific participant (by username)')
+        parser.add_argument('-j', '--jobs', default=multiprocessing.cpu_count(), type=int,
+                            help='Number of certificates to generate in parallel')
+        parser.add_argument('--resume', default=False, action='store_true',
+                            help='Only send to participants an interrupted run did not get to')
+        parser.add_argument('--only-failed', default=False, action='store_true',
+                            help='Only send to participants whose certificate failed to send')
+        parser.add_argument('--since', default=None,
+                            help='Only use ledger entries updated since this date or datetime; '
+                                 'without --resume or --only-failed, resend to anyone not sent a certificate since then')
 
     def handle(self, *args, **options):
-        if options['resend']:
-            self.stdout.write("Resending for {}".format(options['resend']))
-            checked_in = [base_models.Participant.objects.get(user__username=options['resend'])]
-        else:
-            self.stdout.write("Sending certifications to checked-in blue team participants")
-            checked_in = base_models.Participant.objects.filter(checked_in=True, is_red=False, is_green=False,
-                                                                team__isnull=False)
-
         cert_file = base_actions.get_global_setting('certificate_template')
         if not cert_file:
             self.stderr.write(self.style.ERROR('You need to specify a certificate template'))
@@ -47,47 +74,152 @@ class Command(BaseCommand):
 
         cdc_name = base_actions.get_global_setting('competition_name')
         cdc_date = base_actions.get_global_setting('competition_date').strftime('%B %-d, %Y')
-        emails = []
-
-        tmp = tempfile.mkdtemp(prefix="signup-certs")
-
-        num = 0
-        for participant in checked_in:
-            fields = [
-                ('participant_name', participant.user.get_full_name()),
-                ('cdc_name', cdc_name),
-                ('issue_date', cdc_date),
-            ]
-
-            outfile = slugify(participant.user.username) + '.pdf'
-
-            # Forge FDF
-            fdf = forge_fdf("", fields, [], [], [])
-            with open(os.path.join(tmp, 'data.fdf'), 'w') as fp:
-                fp.write(fdf)
-
-            # Fill PDF
-            subprocess.check_call(["pdftk", cert_file, 'fill_form', 'data.fdf', 'output', outfile, 'flatten'], cwd=tmp)
-
-            subject = "[CDC] {} Certificate".format(cdc_name)
-            body = CERTIFICATE.format(fname=participant.user.first_name, lname=participant.user.last_name,
-                                      support=settings.SUPPORT_EMAIL)
+        ledger_name = cdc_name or ""
 
+        if options['resend']:
+            self.stdout.write("Resending for {}".format(options['resend']))
+            checked_in = base_models.Participant.objects.filter(user__username=options['resend'])
+            if not checked_in.exists():
+                raise CommandError("No participant with username {}".format(options['resend']))
+        else:
+            checked_in = self.select_participants(ledger_name, options)
+
+        participants = dict((participant.user.username, participant) for participant in checked_in.select_related('user'))
+        if not options['dry_run']:
+            self.open_ledger(ledger_name, participants.values())
+        certificates, failed = self.generate(cert_file, participants, cdc_name, cdc_date, options)
+        if not options['dry_run']:
+            for username, error in failed:
+                self.record(ledger_name, participants[username], base_models.CertificateDelivery.FAILED, error)
+
+        dispatcher = base_mail.MailDispatcher(per_minute=options['rate'], burst=options['burst'])
+        emails = email_templates.render_many('certificate', [
+            dict(fname=participants[username].user.first_name, lname=participants[username].user.last_name)
+            for username, pdf in certificates], cdc_name=cdc_name)
+        for (username, pdf), (subject, body) in zip(certificates, emails):
+            participant = participants[username]
             message = EmailMessage(subject, body, settings.SUPPORT_EMAIL, [participant.user.email],
                                    reply_to=[settings.SUPPORT_EMAIL])
-            message.attach_file(os.path.join(tmp, outfile))
-            emails.append(message)
+            message.attach(slugify(username) + '.pdf', pdf, 'application/pdf')
             if options['names']:
                 self.stdout.write(" -> Generated Email for {}".format(participant))
 
             if not options['dry_run']:
                 self.stdout.write(" -> Sending mail for {}".format(participant), self.style.MIGRATE_SUCCESS)
-                message.send()
-                num += 1
-
-                if num > options['batch']:
-                    time.sleep(BATCH_TIMER)
-                    num = 0
-
-        if not options['no_clean']:
-            shutil.rmtree(tmp)
+                try:
+                    dispatcher.send(message)
+                except base_mail.MailDispatcher.ERRORS as e:
+                    self.stderr.write(self.style.ERROR(" -> Failed to send mail for {}: {}".format(participant, e)))
+                    self.record(ledger_name, participant, base_models.CertificateDelivery.FAILED, repr(e))
+                else:
+                    self.record(ledger_name, participant, base_models.CertificateDelivery.SENT)
+
+        dispatcher.close()
+        if not options['dry_run']:
+            self.stdout.write(dispatcher.report(), self.style.MIGRATE_HEADING)
+
+    def select_participants(self, ledger_name, options):
+        """
+        Pick the checked-in blue team participants to send to, using the ledger of earlier runs.
+        """
+        checked_in = base_models.Participant.objects.filter(checked_in=True, is_red=False, is_green=False,
+                                                            team__isnull=False)
+        ledger = base_models.CertificateDelivery.objects.filter(competition_name=ledger_name)
+        if options['since']:
+            ledger = ledger.filter(updated__gte=self.parse_since(options['since']))
+
+        if options['resume'] or options['only_failed']:
+            statuses = []
+            if options['resume']:
+                statuses.append(base_models.CertificateDelivery.PENDING)
+            if options['only_failed']:
+                statuses.append(base_models.CertificateDelivery.FAILED)
+            self.stdout.write("Sending certificates left {} by earlier runs".format(" or ".join(statuses)))
+            return checked_in.filter(pk__in=ledger.filter(status__in=statuses).values('participant_id'))
+
+        self.stdout.write("Sending certifications to checked-in blue team participants")
+        sent = ledger.filter(status=base_models.CertificateDelivery.SENT)
+        skipped = sent.count()
+        if skipped:
+            self.stdout.write("Skipping {} participant(s) who already received the certificate".format(skipped))
+        return checked_in.exclude(pk__in=sent.values('participant_id'))
+
+    @staticmethod
+    def parse_since(value):
+        since = dateparse.parse_datetime(value)
+        if since is None:
+            date = dateparse.parse_date(value)
+            if date is None:
+                raise CommandError("--since must be a date or datetime, e.g. 2026-10-18 or 2026-10-18T13:00")
+            since = datetime.datetime.combine(date, datetime.time())
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    @staticmethod
+    def open_ledger(ledger_name, participants):
+        """
+        Mark everyone in this run as pending, so --resume finds them if the run dies.
+        """
+        ids = [participant.pk for participant in participants]
+        ledger = base_models.CertificateDelivery.objects.filter(competition_name=ledger_name)
+        existing = set(ledger.filter(participant_id__in=ids).values_list('participant_id', flat=True))
+        base_models.CertificateDelivery.objects.bulk_create(
+            [base_models.CertificateDelivery(participant_id=pk, competition_name=ledger_name)
+             for pk in ids if pk not in existing])
+        ledger.filter(participant_id__in=existing).update(status=base_models.CertificateDelivery.PENDING,
+                                                          updated=timezone.now())
+
+    @staticmethod
+    def record(ledger_name, participant, status, error=""):
+        base_models.CertificateDelivery.objects.filter(participant=participant, competition_name=ledger_name) \
+            .update(status=status, attempts=F('attempts') + 1, last_error=error, updated=timezone.now())
+
+    def generate(self, cert_file, participants, cdc_name, cdc_date, options):
+        """
+        Render every certificate before anything is sent, using a pool of --jobs processes.
+        Returns a list of (username, pdf contents) and a list of (username, error) for the certificates
+        that failed to render.
+        """
+        jobs = [(username, base_certificates.certificate_fields(participant.user.get_full_name(), cdc_name, cdc_date))
+                for username, participant in participants.items()]
+
+        total = len(jobs)
+        self.stdout.write("Generating {} certificate(s) with {} job(s)".format(total, options['jobs']))
+        start = time.time()
+        certificates = []
+        failed = []
+
+        # Forked workers must not share the database connection. They never use it, so inside a
+        # transaction (e.g. bench_mail) it is left open rather than breaking the transaction
+        if not connection.in_atomic_block:
+            connections.close_all()
+        pool = multiprocessing.Pool(max(options['jobs'], 1), start_renderer, (cert_file,))
+        try:
+            for username, pdf, error in pool.imap_unordered(render_certificate, jobs):
+                if error is None:
+                    certificates.append((username, pdf))
+                else:
+                    self.stderr.write(self.style.ERROR(" -> Failed to generate certificate for {}: {}".format(
+                        participants[username], error)))
+                    failed.append((username, error))
+                done = len(certificates) + len(failed)
+                if done % PROGRESS_EVERY == 0 or done == total:
+                    elapsed = time.time() - start
+                    self.stdout.write(" -> Generated {done}/{total} ({rate:.1f}/s)".format(
+                        done=done, total=total, rate=done / elapsed if elapsed else 0))
+        finally:
+            pool.close()
+            pool.join()
+
+        if options['output_dir']:
+            for username, pdf in certificates:
+                with open(os.path.join(options['output_dir'], slugify(username) + '.pdf'), 'wb') as fp:
+                    fp.write(pdf)
+
+        elapsed = time.time() - start
+        self.stdout.write("Generated {} certificate(s) in {:.1f}s".format(len(certificates), elapsed),
+                          self.style.MIGRATE_HEADING)
+        if failed:
+            self.stderr.write(self.style.ERROR("Failed to generate {} certificate(s)".format(len(failed))))
+        return certificates, failed
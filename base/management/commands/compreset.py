@@ -1,11 +1,13 @@
 from django.core.management.base import BaseCommand, CommandError
-from base import models
+from base import actions, models
 from django.contrib.auth.models import User
+from django.db import transaction
 
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
-        User.objects.exclude(is_superuser=True).delete()
-        models.Team.objects.all().delete()
-        models.ArchivedEmail.objects.all().delete()
+        with actions.batch_group_changes(), transaction.atomic():
+            User.objects.exclude(is_superuser=True).delete()
+            models.Team.objects.all().delete()
+            models.ArchivedEmail.objects.all().delete()
         self.stdout.write("Competition reset performed")
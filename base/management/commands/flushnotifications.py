@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from base import notifications
+
+
+class Command(BaseCommand):
+    help = 'Send captain notification digests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', default=False, action='store_true',
+                            help="Send every waiting notification, even if its digest window hasn't passed")
+        parser.add_argument('--loop', default=False, action='store_true', help='Keep polling for due digests')
+        parser.add_argument('--interval', default=settings.CAPTAIN_DIGEST_POLL_INTERVAL, type=float,
+                            help='Seconds to wait between polls')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            count = notifications.flush(window=0 if options['all'] else None)
+            if count:
+                self.stdout.write("Sent {} digest(s)".format(count))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from base import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued Active Directory operations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', default=False, action='store_true', help='Run the jobs that are due and exit')
+        parser.add_argument('--interval', default=settings.LDAP_JOB_POLL_INTERVAL, type=float,
+                            help='Seconds to wait between polls when the queue is empty')
+
+    def handle(self, *args, **options):
+        stalled = jobs.requeue_stalled()
+        if stalled:
+            self.stdout.write("Requeued {} stalled job(s)".format(stalled))
+
+        while True:
+            close_old_connections()
+            count = jobs.run_pending()
+            if count:
+                self.stdout.write("Ran {} job(s)".format(count))
+            if options['once']:
+                break
+            time.sleep(options['interval'])
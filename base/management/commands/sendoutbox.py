@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from base import outbox
+
+
+class Command(BaseCommand):
+    help = 'Send queued participant emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default=settings.EMAIL_OUTBOX_WORKERS, type=int,
+                            help='Number of SMTP connections to send over in parallel')
+        parser.add_argument('--batch', default=settings.EMAIL_OUTBOX_BATCH_SIZE, type=int,
+                            help='Number of messages a connection sends before taking the next batch')
+        parser.add_argument('--loop', default=False, action='store_true', help='Keep polling for new emails')
+        parser.add_argument('--interval', default=settings.EMAIL_OUTBOX_POLL_INTERVAL, type=float,
+                            help='Seconds to wait between polls when the outbox is empty')
+
+    def handle(self, *args, **options):
+        stalled = outbox.requeue_stalled()
+        if stalled:
+            self.stdout.write("Requeued {} message(s) that were being sent".format(stalled))
+
+        while True:
+            close_old_connections()
+            start = time.time()
+            sent, failed = outbox.send_pending(workers=options['workers'], batch_size=options['batch'])
+            if sent or failed:
+                elapsed = time.time() - start
+                self.stdout.write("Sent {} message(s), {} failed in {:.1f}s ({:.1f}/min)".format(
+                    sent, failed, elapsed, sent * 60 / elapsed if elapsed else 0))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
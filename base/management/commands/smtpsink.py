@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from base import smtp_sink
+
+
+class Command(BaseCommand):
+    help = 'Run a local SMTP server that accepts and counts messages without delivering them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', default=1025, type=int)
+        parser.add_argument('--interval', default=5, type=float, help='Seconds between reports')
+
+    def handle(self, *args, **options):
+        sink = smtp_sink.SMTPSink(options['host'], options['port'])
+        sink.start()
+        self.stdout.write("Accepting mail on {}:{}. Point EMAIL_HOST and EMAIL_PORT at it.".format(sink.host, sink.port),
+                          self.style.MIGRATE_HEADING)
+
+        last = 0
+        try:
+            while True:
+                time.sleep(options['interval'])
+                count = sink.count
+                if count != last:
+                    self.stdout.write("{} message(s), {:.1f}/s over the last {:.0f}s".format(
+                        count, (count - last) / options['interval'], options['interval']))
+                    last = count
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sink.stop()
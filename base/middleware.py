@@ -0,0 +1,83 @@
+import time
+
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+
+from base import models
+
+SESSION_REFRESHED_KEY = '_refreshed'
+
+# Where user.participant caches the participant
+PARTICIPANT_CACHE = models.Participant._meta.get_field('user').remote_field.get_cache_name()
+
+
+def set_session_value(session, key, value):
+    """
+    Store a value in the session, only marking it modified (and so written) if the value changed.
+    """
+    if session.get(key) != value:
+        session[key] = value
+
+
+def set_session_value_lazily(session, key, value):
+    """
+    Store a value that isn't worth a write of its own. It is saved with the next change or expiry refresh.
+    """
+    if session.get(key) != value:
+        modified = session.modified
+        session[key] = value
+        session.modified = modified
+
+
+class SlidingSessionMiddleware(MiddlewareMixin):
+    """
+    Pushes the session expiry back at most once per SESSION_REFRESH_INTERVAL seconds, instead of
+    SESSION_SAVE_EVERY_REQUEST saving the session on every request.
+
+    Must come after SessionMiddleware so its response is processed first.
+    """
+
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        # Leave new sessions alone, a value set lazily shouldn't create one
+        if session is None or session.modified or session.session_key is None:
+            return response
+
+        now = int(time.time())
+        if now - session.get(SESSION_REFRESHED_KEY, 0) >= settings.SESSION_REFRESH_INTERVAL:
+            # Marks the session modified, so SessionMiddleware saves it and renews the cookie
+            session[SESSION_REFRESHED_KEY] = now
+        return response
+
+
+def get_participant(request):
+    """
+    The participant of the logged in user, loaded once per request with its teams. The row is only
+    created if it is missing.
+    """
+    if not request.user.is_authenticated:
+        return None
+    if not hasattr(request, '_participant'):
+        try:
+            participant = models.Participant.objects.select_related('team', 'requested_team').get(user_id=request.user.pk)
+        except models.Participant.DoesNotExist:
+            participant = models.Participant.objects.get_or_create(user_id=request.user.pk)[0]
+        # Also makes request.user.participant this object
+        participant.user = request.user
+        request._participant = participant
+    return request._participant
+
+
+class ParticipantMiddleware(MiddlewareMixin):
+    """
+    Sets request.participant, and request.user.participant, to the participant loaded by get_participant
+    the first time either is used.
+
+    Must come after AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        request.participant = SimpleLazyObject(lambda: get_participant(request))
+        if request.user.is_authenticated:
+            setattr(request.user, PARTICIPANT_CACHE, request.participant)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_members(apps, schema_editor):
+    Team = apps.get_model('base', 'Team')
+    Participant = apps.get_model('base', 'Participant')
+    counts = Participant.objects.exclude(team=None).order_by().values_list('team').annotate(Count('id'))
+    for team_id, count in counts:
+        Team.objects.filter(pk=team_id).update(member_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0027_ldapjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Maintained by the Participant save/delete signals.'),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
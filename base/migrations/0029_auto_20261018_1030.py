@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0028_team_member_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='team',
+            name='number',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0030_emailrecipient'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailrecipient',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('deferred', 'Deferred'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10),
+        ),
+    ]
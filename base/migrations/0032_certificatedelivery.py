@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0031_emailrecipient_deferred'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CertificateDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('competition_name', models.CharField(max_length=100)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.Participant')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='certificatedelivery',
+            unique_together=set([('participant', 'competition_name')]),
+        ),
+    ]
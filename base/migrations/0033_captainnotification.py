@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0032_certificatedelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaptainNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(choices=[('member_joined', 'Member joined'), ('member_left', 'Member left'), ('join_request', 'Join request'), ('captain_request', 'Captain request'), ('stepped_down', 'Captain stepped down')], max_length=20)),
+                ('message', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent_time', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.Team')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0033_captainnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='captainnotification',
+            name='delivered_to',
+            field=models.ManyToManyField(blank=True, help_text='Captains who got this event in a digest.', related_name='+', to='base.Participant'),
+        ),
+    ]
@@ -1,11 +1,51 @@
 from django.contrib.auth import models as auth_models
-from django.db import models
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db import models, transaction
+from django.db.models import Case, Count, F, IntegerField, Sum, When
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_init, post_save, pre_save, pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
 from base.utils import AUDIENCE_CHOICES
 
 
+class TrackedFieldsMixin(object):
+    """
+    Remembers the values of tracked_fields (attribute names) as they were loaded from the database,
+    so that signal handlers can tell what a save actually changed without another query.
+    """
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(TrackedFieldsMixin, cls).from_db(db, field_names, values)
+        instance._loaded_values = dict((name, getattr(instance, name))
+                                       for name in cls.tracked_fields if name in instance.__dict__)
+        return instance
+
+    def was_loaded(self, name):
+        return name in getattr(self, '_loaded_values', {})
+
+    def loaded_value(self, name):
+        return self._loaded_values[name]
+
+    def has_changed(self, name):
+        if not self.was_loaded(name):
+            return True
+        return self.loaded_value(name) != getattr(self, name)
+
+    def save(self, *args, **kwargs):
+        super(TrackedFieldsMixin, self).save(*args, **kwargs)
+
+        # Only the fields that were written now match the database
+        update_fields = kwargs.get('update_fields')
+        if not hasattr(self, '_loaded_values'):
+            self._loaded_values = {}
+        for name in self.tracked_fields:
+            if update_fields is None or name in update_fields or name.replace('_id', '') in update_fields:
+                self._loaded_values[name] = getattr(self, name)
+
+
 class GlobalSettings(models.Model):
     number_of_teams = models.IntegerField(default=40)
     administrator_bind_dn = models.CharField(max_length=100)
@@ -33,11 +73,38 @@ class GlobalSettings(models.Model):
     rules_version = models.CharField(max_length=40, null=True, blank=True)
 
 
-class Team(models.Model):
-    number = models.PositiveIntegerField(default=0)
+class TeamQuerySet(models.QuerySet):
+    def with_roster(self):
+        """
+        Prefetch every team's members and join requests along with their users, in two queries for
+        the whole queryset. Use the Team roster methods to read them.
+        """
+        participants = Participant.objects.select_related('user')
+        return self.prefetch_related(
+            models.Prefetch('participant_set', queryset=participants, to_attr='roster'),
+            models.Prefetch('requested_team', queryset=participants, to_attr='requester_roster'),
+        )
+
+
+class Team(TrackedFieldsMixin, models.Model):
+    tracked_fields = ('number',)
+
+    number = models.PositiveIntegerField(default=0, db_index=True)
     name = models.CharField(unique=True, max_length=50)
     looking_for_members = models.BooleanField(default=True, help_text="Allow anyone to join your team; uncheck if your team is full.")
     disbanded = models.BooleanField(default=False)
+    member_count = models.PositiveIntegerField(default=0, editable=False,
+                                               help_text="Maintained by the Participant save/delete signals.")
+
+    objects = TeamQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        # member_count is only ever changed with UPDATE ... SET member_count = member_count + n; never write
+        # back the possibly stale copy held by this instance
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'member_count']
+        super(Team, self).save(*args, **kwargs)
 
     def members(self):
         return Participant.objects.filter(team=self)
@@ -51,31 +118,45 @@ class Team(models.Model):
     def requested_captains(self):
         return self.members().filter(requests_captain=True)
 
+    # The roster methods load participants with their users at most once per instance, or use the
+    # lists prefetched by Team.objects.with_roster()
+    def get_roster(self):
+        if not hasattr(self, 'roster'):
+            self.roster = list(self.members().select_related('user'))
+        return self.roster
+
+    def get_captain_roster(self):
+        return [member for member in self.get_roster() if member.captain]
+
+    def get_captain_request_roster(self):
+        return [member for member in self.get_roster() if member.requests_captain]
+
+    def get_requester_roster(self):
+        if not hasattr(self, 'requester_roster'):
+            self.requester_roster = list(self.requested_members().select_related('user'))
+        return self.requester_roster
+
     def member_email_list(self):
-        member_emails = []
-        for member in self.members():
-            member_emails.append(member.user.email)
-        return member_emails
+        return [member.user.email for member in self.get_roster()]
+
+    def captain_email_list(self):
+        return [captain.user.email for captain in self.get_captain_roster()]
 
     def captain_names(self):
-        names = []
-        for captain in self.captains():
-            name = captain.user.get_full_name()
-            names.append(name)
-        formatted = ', '.join(names)
-        return formatted
+        return ', '.join(captain.user.get_full_name() for captain in self.get_captain_roster())
 
     def captain_emails(self):
-        emails = ''
-        for captain in self.captains():
-            if len(emails):
-                emails += ', '
-            emails = emails + captain.user.email
-        return emails
+        return ', '.join(self.captain_email_list())
+
+    def size(self):
+        """
+        The number of members, counted by the database. member_count is cheaper for display.
+        """
+        return self.members().count()
 
     def is_full(self):
         from base import actions
-        return len(self.members()) >= actions.get_global_setting('max_team_size')
+        return self.size() >= actions.get_global_setting('max_team_size')
 
     def __unicode__(self):
         return "Team {number}: {name}".format(number=self.number, name=self.name)
@@ -84,7 +165,42 @@ class Team(models.Model):
         ordering = ['number']
 
 
-class Participant(models.Model):
+class ParticipantQuerySet(models.QuerySet):
+    def update_with_side_effects(self, **fields):
+        """
+        Update every participant in the queryset with a single UPDATE, running the side effects that
+        Participant.save() signals would have run for each row: AD group changes (batched), team member
+        counts and cached DNs.
+        """
+        from base import actions
+
+        with actions.batch_group_changes(), transaction.atomic():
+            if 'team' in fields:
+                team = fields['team']
+                moving = self.exclude(team=team)
+                old_counts = moving.exclude(team=None).order_by().values_list('team').annotate(Count('id'))
+                for team_id, count in old_counts:
+                    Team.objects.filter(pk=team_id).update(member_count=F('member_count') - count)
+                if team:
+                    Team.objects.filter(pk=team.pk).update(member_count=F('member_count') + moving.count())
+
+                for participant in moving.select_related('user', 'team'):
+                    user_dn = actions.get_user_dn(participant)
+                    if participant.team:
+                        actions.queue_group_change(participant, user_dn, actions.get_group_dn(participant.team),
+                                                   add=False)
+                    if team:
+                        actions.queue_group_change(participant, user_dn, actions.get_group_dn(team))
+
+            if 'is_red' in fields or 'is_green' in fields:
+                actions.forget_user_dns(self.values_list('id', flat=True))
+
+            return self.update(**fields)
+
+
+class Participant(TrackedFieldsMixin, models.Model):
+    tracked_fields = ('team_id', 'is_red', 'is_green')
+
     user = models.OneToOneField(auth_models.User)
     team = models.ForeignKey('Team', blank=True, null=True)
     captain = models.BooleanField(default=False)
@@ -98,6 +214,13 @@ class Participant(models.Model):
     is_green = models.BooleanField(default=False)
     approved = models.BooleanField(default=False)
 
+    objects = ParticipantQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        # Team.member_count is updated by a post_save signal, which has to commit or roll back with this row
+        with transaction.atomic():
+            super(Participant, self).save(*args, **kwargs)
+
     @property
     def is_redgreen(self):
         return self.is_red or self.is_green
@@ -165,6 +288,18 @@ class Participant(models.Model):
         ordering = ['team']
 
 
+class ArchivedEmailQuerySet(models.QuerySet):
+    def with_delivery_counts(self):
+        """
+        Annotate every email with the number of recipients in each EmailRecipient status, e.g. email.sent_count.
+        """
+        counts = {}
+        for status, name in EmailRecipient.STATUS_CHOICES:
+            counts[status + '_count'] = Sum(Case(When(recipients__status=status, then=1), default=0,
+                                                 output_field=IntegerField()))
+        return self.annotate(recipient_count=Count('recipients'), **counts)
+
+
 class ArchivedEmail(models.Model):
     subject = models.CharField(max_length=200)
     content = models.TextField()
@@ -173,6 +308,139 @@ class ArchivedEmail(models.Model):
 
     sender = models.ForeignKey(auth_models.User)
 
+    objects = ArchivedEmailQuerySet.as_manager()
+
+    def undelivered(self):
+        return self.recipients.filter(status__in=EmailRecipient.UNDELIVERED)
+
+
+class EmailRecipient(models.Model):
+    """
+    One delivery of an ArchivedEmail, queued in the outbox and sent by the sendoutbox command.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    DEFERRED = 'deferred'  # temporary error, resuming the email tries again
+    FAILED = 'failed'  # the server refused the address
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (DEFERRED, 'Deferred'),
+        (FAILED, 'Failed'),
+    )
+    UNDELIVERED = (DEFERRED, FAILED)
+
+    email = models.ForeignKey('ArchivedEmail', related_name='recipients', on_delete=models.CASCADE)
+    address = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    sent_time = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "{address} ({status})".format(address=self.address, status=self.status)
+
+    class Meta:
+        ordering = ['id']
+
+
+class LDAPJob(models.Model):
+    """
+    An Active Directory operation queued to run outside the request by the ldapworker command.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    action = models.CharField(max_length=50)
+    arguments = models.TextField(default='{}')
+    key = models.CharField(max_length=255, db_index=True, help_text="Idempotency key; an identical unfinished job is not queued twice.")
+    participant = models.ForeignKey('Participant', blank=True, null=True, on_delete=models.SET_NULL)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "{action} ({status})".format(action=self.action, status=self.status)
+
+    class Meta:
+        ordering = ['id']
+
+
+class CaptainNotification(models.Model):
+    """
+    A team event for the captains, held until the flushnotifications command sends it in a digest.
+    """
+    MEMBER_JOINED = 'member_joined'
+    MEMBER_LEFT = 'member_left'
+    JOIN_REQUEST = 'join_request'
+    CAPTAIN_REQUEST = 'captain_request'
+    STEPPED_DOWN = 'stepped_down'
+    EVENT_CHOICES = (
+        (MEMBER_JOINED, 'Member joined'),
+        (MEMBER_LEFT, 'Member left'),
+        (JOIN_REQUEST, 'Join request'),
+        (CAPTAIN_REQUEST, 'Captain request'),
+        (STEPPED_DOWN, 'Captain stepped down'),
+    )
+
+    team = models.ForeignKey('Team', on_delete=models.CASCADE)
+    event = models.CharField(max_length=20, choices=EVENT_CHOICES)
+    message = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    # Set once every captain got the event in a digest
+    sent_time = models.DateTimeField(null=True, blank=True, db_index=True)
+    delivered_to = models.ManyToManyField('Participant', blank=True, related_name='+',
+                                          help_text="Captains who got this event in a digest.")
+
+    def __unicode__(self):
+        return "{team}: {event}".format(team=self.team, event=self.get_event_display())
+
+    class Meta:
+        ordering = ['id']
+
+
+class CertificateDelivery(models.Model):
+    """
+    Ledger of the certificates command: whether a participant got the certificate for a competition.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    participant = models.ForeignKey('Participant', on_delete=models.CASCADE)
+    competition_name = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "{participant}: {competition} ({status})".format(participant=self.participant,
+                                                               competition=self.competition_name, status=self.status)
+
+    class Meta:
+        ordering = ['id']
+        unique_together = ('participant', 'competition_name')
+
 
 ########
 # Signals
@@ -180,7 +448,20 @@ class ArchivedEmail(models.Model):
 @receiver(post_save, sender=GlobalSettings)
 def update_settings(sender, instance, **kwargs):
     from base import actions
-    actions.reset_global_settings_object()
+    actions.reset_global_settings_object(instance)
+
+
+@receiver(post_save, sender=ArchivedEmail)
+@receiver(post_delete, sender=ArchivedEmail)
+def update_archive_version(sender, **kwargs):
+    from base import actions
+    actions.new_archive_version()
+
+
+@receiver(request_started)
+def expire_global_settings(sender, **kwargs):
+    from base import actions
+    actions.expire_global_settings()
 
 
 @receiver(post_save, sender=auth_models.User)
@@ -188,42 +469,120 @@ def create_participant(sender, instance, **kwargs):
     Participant.objects.get_or_create(user=instance)
 
 
-@receiver(pre_save, sender=Participant)
-def remove_old_ad_group(sender, instance, **kwargs):
+# The User fields that make up the CN of the user's DN
+USER_DN_FIELDS = ('first_name', 'last_name')
+
+
+@receiver(post_init, sender=auth_models.User)
+def remember_user_names(sender, instance, **kwargs):
+    # What TrackedFieldsMixin does for our own models, User can't use it
+    if instance.pk is not None and all(name in instance.__dict__ for name in USER_DN_FIELDS):
+        instance._loaded_names = tuple(getattr(instance, name) for name in USER_DN_FIELDS)
+
+
+@receiver(post_save, sender=auth_models.User)
+def forget_user_dn(sender, instance, created, update_fields=None, **kwargs):
+    from base import actions
+    # A new user has no DN cached yet
+    if created or (update_fields and not set(update_fields) & set(USER_DN_FIELDS)):
+        return
+    names = tuple(getattr(instance, name) for name in USER_DN_FIELDS)
+    if getattr(instance, '_loaded_names', None) == names:
+        return
+    instance._loaded_names = names
+    actions.forget_user_dns(Participant.objects.filter(user=instance).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Participant)
+def forget_participant_dn(sender, instance, **kwargs):
+    from base import actions
+    if instance.has_changed('is_red') or instance.has_changed('is_green'):
+        actions.forget_user_dns([instance.id])
+
+
+@receiver(post_save, sender=Team)
+def forget_team_dn(sender, instance, **kwargs):
     from base import actions
+    if instance.has_changed('number'):
+        actions.forget_group_dn(instance.id)
+
+
+@receiver(pre_save, sender=Participant)
+def track_team_change(sender, instance, **kwargs):
+    """
+    Work out whether this save moves the participant between teams, for the receivers below.
+    """
+    instance._team_change = None
     fields = kwargs.get('update_fields', None)
     if fields:
         if not 'team' in fields:
             return
 
-    try:
-        current = Participant.objects.get(pk=instance.id)
-    except Participant.DoesNotExist:
+    if instance.was_loaded('team_id'):
+        old_team_id = instance.loaded_value('team_id')
+    elif instance.pk:
+        # Only hit the database if the instance was loaded without its team
+        old_team_id = Participant.objects.filter(pk=instance.pk).values_list('team_id', flat=True).first()
+    else:
+        old_team_id = None
+
+    if old_team_id != instance.team_id:
+        instance._team_change = (old_team_id, instance.team_id)
+
+
+@receiver(pre_save, sender=Participant)
+def remove_old_ad_group(sender, instance, **kwargs):
+    from base import actions
+    if instance._team_change is None:
         return
-    team = current.team
-    if team:
-        user_dn = actions.get_user_dn(instance.id)
-        group_dn = actions.get_group_dn(team.id)
-        actions.remove_user_from_group(user_dn, group_dn)
+
+    old_team_id, new_team_id = instance._team_change
+    if old_team_id:
+        user_dn = actions.get_user_dn(instance)
+        group_dn = actions.get_group_dn(old_team_id)
+        actions.queue_group_change(instance, user_dn, group_dn, add=False)
 
 
 @receiver(post_save, sender=Participant)
 def add_new_ad_group(sender, instance, **kwargs):
     from base import actions
-    fields = kwargs.get('update_fields', None)
-    if fields:
-        if not 'team' in fields:
-            return
+    if instance._team_change is None:
+        return
+
+    old_team_id, new_team_id = instance._team_change
+    if new_team_id:
+        user_dn = actions.get_user_dn(instance)
+        group_dn = actions.get_group_dn(instance.team)
+        actions.queue_group_change(instance, user_dn, group_dn)
+
+
+@receiver(post_save, sender=Participant)
+def update_member_counts(sender, instance, **kwargs):
+    # Runs inside the transaction opened by Participant.save()
+    if instance._team_change is None:
+        return
+
+    old_team_id, new_team_id = instance._team_change
+    if old_team_id:
+        Team.objects.filter(pk=old_team_id).update(member_count=F('member_count') - 1)
+    if new_team_id:
+        Team.objects.filter(pk=new_team_id).update(member_count=F('member_count') + 1)
+
 
-    team = instance.team
-    if team:
-        user_dn = actions.get_user_dn(instance.id)
-        group_dn = actions.get_group_dn(team.id)
-        actions.add_user_to_group(user_dn, group_dn)
+@receiver(post_delete, sender=Participant)
+def remove_member_count(sender, instance, **kwargs):
+    if instance.team_id:
+        Team.objects.filter(pk=instance.team_id).update(member_count=F('member_count') - 1)
 
 
 @receiver(pre_delete, sender=Team)
 def remove_members(sender, instance, **kwargs):
+    from base import actions
+    with actions.batch_group_changes():
+        _remove_members(instance)
+
+
+def _remove_members(instance):
     rc = instance.requested_captains()
     for member in rc:
         member.requests_captain = False
@@ -0,0 +1,97 @@
+import datetime
+import logging
+import smtplib
+
+from django.conf import settings
+from django.core.mail import EmailMessage, send_mail
+from django.db.models import Min
+from django.utils import timezone
+
+from base import email_templates, mail, models
+
+# event: (email_templates name of the immediate email, line in the digest)
+EVENTS = {
+    models.CaptainNotification.MEMBER_JOINED: ('member_joined', "{fname} {lname} ({email}) joined the team."),
+    models.CaptainNotification.MEMBER_LEFT: ('left_team', "{fname} {lname} ({email}) left the team."),
+    models.CaptainNotification.JOIN_REQUEST: ('join_request_submitted',
+                                              "{fname} {lname} ({email}) requested to join the team."),
+    models.CaptainNotification.CAPTAIN_REQUEST: ('captain_request_submitted',
+                                                 "{fname} {lname} ({email}) requested to become a captain."),
+    models.CaptainNotification.STEPPED_DOWN: ('stepped_down', "{fname} {lname} stepped down as a captain."),
+}
+
+
+def notify_captains(team, event, participant):
+    """
+    Tell the captains of a team about something a participant did. With CAPTAIN_DIGEST_WINDOW set the
+    event waits for the next digest, otherwise it is emailed right away.
+    """
+    template, line = EVENTS[event]
+    values = dict(fname=participant.user.first_name, lname=participant.user.last_name,
+                  email=participant.user.email, team=team.name)
+
+    if settings.CAPTAIN_DIGEST_WINDOW:
+        models.CaptainNotification.objects.create(team=team, event=event, message=line.format(**values))
+        return
+
+    subject, email_body = email_templates.render(template, **values)
+    try:
+        send_mail(subject, email_body, settings.EMAIL_FROM_ADDR, team.captain_email_list())
+    except smtplib.SMTPException:
+        logging.warning("Failed to send email to captains of {team}:\n{body}".format(team=team.name, body=email_body))
+
+
+def due_teams(window=None):
+    """
+    Teams whose oldest unsent notification has waited for at least the digest window.
+    """
+    window = settings.CAPTAIN_DIGEST_WINDOW if window is None else window
+    cutoff = timezone.now() - datetime.timedelta(seconds=window)
+    return models.Team.objects.filter(captainnotification__sent_time__isnull=True) \
+        .annotate(oldest_notification=Min('captainnotification__created')) \
+        .filter(oldest_notification__lte=cutoff)
+
+
+def flush(window=None):
+    """
+    Send each captain of every due team a digest of the events they haven't got yet. An event is marked
+    sent once every captain got it, so a captain whose digest failed gets it on the next flush without the
+    others getting it twice. Returns the number of digests sent.
+    """
+    sent = 0
+    delivered = models.CaptainNotification.delivered_to.through
+    with mail.MailDispatcher() as dispatcher:
+        for team in due_teams(window):
+            notifications = list(models.CaptainNotification.objects.filter(team=team, sent_time__isnull=True))
+            # (notification id, captain id) of the events captains already got
+            received = set(delivered.objects.filter(captainnotification__in=notifications)
+                           .values_list('captainnotification_id', 'participant_id'))
+            missed = False
+            for captain in team.get_captain_roster():
+                events = [notification for notification in notifications
+                          if (notification.pk, captain.pk) not in received]
+                if not events:
+                    continue
+
+                subject, email_body = email_templates.render(
+                    'captain_digest', fname=captain.user.first_name, lname=captain.user.last_name, team=team.name,
+                    events="\n".join("- {time}: {message}".format(
+                        time=timezone.localtime(notification.created).strftime('%I:%M %p'),
+                        message=notification.message) for notification in events))
+                message = EmailMessage(subject, email_body, settings.EMAIL_FROM_ADDR, [captain.user.email])
+                try:
+                    dispatcher.send(message)
+                except mail.MailDispatcher.ERRORS:
+                    logging.warning("Failed to send digest to {email}:\n{body}".format(email=captain.user.email,
+                                                                                       body=email_body))
+                    missed = True
+                    continue
+                sent += 1
+                delivered.objects.bulk_create([delivered(captainnotification_id=notification.pk,
+                                                         participant_id=captain.pk) for notification in events])
+
+            # Keep the events for the next flush if a captain missed them. Teams without captains just drop them
+            if not missed:
+                models.CaptainNotification.objects.filter(pk__in=[n.pk for n in notifications]) \
+                    .update(sent_time=timezone.now())
+    return sent
@@ -0,0 +1,157 @@
+import logging
+import smtplib
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import connection as db_connection
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from base import mail, models
+
+
+def queue_email(archived, addresses):
+    """
+    Put one outbox row per address for an ArchivedEmail.
+    """
+    models.EmailRecipient.objects.bulk_create(
+        [models.EmailRecipient(email=archived, address=address) for address in addresses], batch_size=500)
+
+
+def is_permanent(error):
+    """
+    Whether an SMTP error means the address will never accept the message (a 5xx reply).
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, message in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+def requeue_stalled():
+    """
+    Put rows that were being sent when a sender died back in the outbox. They may be sent twice.
+    """
+    return models.EmailRecipient.objects.filter(status=models.EmailRecipient.SENDING) \
+        .update(status=models.EmailRecipient.PENDING)
+
+
+class SenderThread(threading.Thread):
+    """
+    Sends batches of outbox rows from a shared queue, one SMTP session per batch, within a rate
+    budget shared by all the threads.
+    """
+
+    def __init__(self, batches, bucket):
+        super(SenderThread, self).__init__()
+        self.daemon = True
+        self.batches = batches
+        self.dispatcher = mail.MailDispatcher(bucket=bucket)
+
+    @property
+    def sent(self):
+        return self.dispatcher.sent
+
+    @property
+    def failed(self):
+        return self.dispatcher.failed
+
+    def run(self):
+        try:
+            with self.dispatcher:
+                while True:
+                    try:
+                        batch = self.batches.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.send_batch(batch)
+        finally:
+            # When run() is called directly the database connection belongs to the caller
+            if threading.current_thread() is self:
+                db_connection.close()
+
+    def send_batch(self, batch):
+        # Claim the rows first so a crash leaves them recognisable as possibly sent
+        models.EmailRecipient.objects.filter(pk__in=batch, status=models.EmailRecipient.PENDING) \
+            .update(status=models.EmailRecipient.SENDING)
+        recipients = models.EmailRecipient.objects.filter(pk__in=batch, status=models.EmailRecipient.SENDING) \
+            .select_related('email')
+
+        # The whole batch goes over one SMTP session; the dispatcher reconnects after a failed send
+        sent = []
+        try:
+            for recipient in recipients:
+                message = EmailMessage(subject=recipient.email.subject,
+                                       body=recipient.email.content,
+                                       to=(recipient.address,),
+                                       from_email=settings.EMAIL_FROM_ADDR)
+                try:
+                    self.dispatcher.send(message)
+                except mail.MailDispatcher.ERRORS as e:
+                    logging.warning("Failed to send email to {email}: {error}".format(email=recipient.address,
+                                                                                     error=e))
+                    self.record_failure(recipient, e, models.EmailRecipient.FAILED if is_permanent(e)
+                                        else models.EmailRecipient.DEFERRED)
+                    continue
+                logging.info("Sent email to {email}".format(email=recipient.address))
+                sent.append(recipient.pk)
+        finally:
+            self.dispatcher.close()
+
+        models.EmailRecipient.objects.filter(pk__in=sent).update(status=models.EmailRecipient.SENT,
+                                                                 sent_time=timezone.now())
+
+    def record_failure(self, recipient, error, status):
+        recipient.status = status
+        recipient.attempts += 1
+        recipient.error = repr(error)
+        recipient.save(update_fields=['status', 'attempts', 'error'])
+
+
+def send_pending(workers=None, batch_size=None, archived=None):
+    """
+    Send every pending outbox row using a pool of SMTP connections. Returns (sent, failed).
+
+    With one worker the rows are sent from the calling thread, so it also works inside a transaction.
+    """
+    workers = workers or settings.EMAIL_OUTBOX_WORKERS
+    batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+
+    pending = models.EmailRecipient.objects.filter(status=models.EmailRecipient.PENDING)
+    if archived is not None:
+        pending = pending.filter(email=archived)
+    ids = list(pending.values_list('id', flat=True))
+    if not ids:
+        return 0, 0
+
+    batches = queue.Queue()
+    for i in range(0, len(ids), batch_size):
+        batches.put(ids[i:i + batch_size])
+
+    bucket = mail.make_bucket()
+    threads = [SenderThread(batches, bucket) for i in range(min(workers, batches.qsize()))]
+    if len(threads) == 1:
+        threads[0].run()
+        return threads[0].sent, threads[0].failed
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(thread.sent for thread in threads), sum(thread.failed for thread in threads)
+
+
+def resume(archived, include_failed=False):
+    """
+    Queue the recipients of an email that did not get it again. Refused addresses are only retried if
+    include_failed is set. Returns the number of recipients queued.
+    """
+    statuses = models.EmailRecipient.UNDELIVERED if include_failed else (models.EmailRecipient.DEFERRED,)
+    count = archived.recipients.filter(status__in=statuses).update(status=models.EmailRecipient.PENDING)
+
+    if count and not settings.EMAIL_OUTBOX_ASYNC:
+        send_pending(archived=archived)
+    return count
@@ -0,0 +1,72 @@
+import asyncore
+import smtpd
+import threading
+import time
+
+from django.core.mail.backends import smtp
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    An SMTP server that accepts every message and only counts and timestamps it, for load testing the mail
+    paths without sending anything. Runs its event loop in a background thread between start() and stop().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.host, self.port = self.socket.getsockname()[:2]
+        # (received time, sender, recipients, size in bytes)
+        self.messages = []
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        with self._lock:
+            self.messages.append((time.time(), mailfrom, rcpttos, len(data)))
+
+    @property
+    def count(self):
+        with self._lock:
+            return len(self.messages)
+
+    def reset(self):
+        with self._lock:
+            self.messages = []
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self.close()
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.1, count=1)
+
+
+class TimedEmailBackend(smtp.EmailBackend):
+    """
+    The SMTP backend, recording how long every send_messages() call takes.
+    """
+    latencies = []
+    _lock = threading.Lock()
+
+    def send_messages(self, email_messages):
+        start = time.time()
+        try:
+            return super(TimedEmailBackend, self).send_messages(email_messages)
+        finally:
+            with self._lock:
+                TimedEmailBackend.latencies.append(time.time() - start)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.latencies = []
@@ -2,9 +2,9 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.template import Library
 from django.utils.safestring import mark_safe
-from django import forms
 
 from base import actions
+from base import form_layouts
 from base import widgets as base_widgets
 
 
@@ -17,56 +17,14 @@ register = Library()
 @register.simple_tag
 def render_field(bound, label=None):
     """ This template tag renders the passed in field in bootstrap horizontal form format. """
-
-    # shortcut for hidden fields
-    if bound.is_hidden:
-        return '<div class="hidden">{widget}</div>'.format(widget=bound)
-
-    # set our css classes
-    classes = ['form-group']
-
-    # setup the required indicator
-    if bound.field.required:
-        required_indicator = '<span class="required-indicator"' \
-                             ' title="This Field is Required">*</span>'
-    else:
-        required_indicator = '<span class="required-indicator">&nbsp;</span>'
-
-    if bound.errors:
-        classes.append('error')
-
-    # setup the label
-    field_label = label or bound.label
-    if not field_label.strip():
-        final_label = ' '
-    elif (isinstance(bound.field.widget, forms.widgets.CheckboxInput)):
-        final_label = '{label}{required}'.format(label=field_label, required=required_indicator)
-    else:
-        final_label = '{label}:{required}'.format(label=field_label, required=required_indicator)
-
-    # render the row
-    ctx = {
-        'name': bound.name,
-        'classes': ' '.join(classes),
-        'label': final_label,
-        'widget': bound,
-        'error': bound.errors,
-    }
-
-    template = '<div id="div_{name}" class="{classes}"><label class="col-sm-2 control-label" for="id_{name}">{label}</label><div class="col-sm-8">{widget}<span class="help-block">{error}</span></div></div>'
-    checkbox_template = '<div id="div_{name}" class="{classes}"><label class="col-sm-9 col-sm-offset-1 checkbox">{widget} {label}</label><span class="help-block">{error}</span></div>'
-    radio_template = '<div id="div_{name}" class="{classes}"><label class="col-sm-9 col-sm-offset-1 radio">{widget}</label><span class="help-block">{error}</span></div>'
-    if (isinstance(bound.field.widget, forms.widgets.CheckboxInput)):
-        return mark_safe(checkbox_template.format(**ctx))
-    elif isinstance(bound.field.widget, forms.widgets.RadioSelect):
-        return mark_safe(radio_template.format(**ctx))
-    return mark_safe(template.format(**ctx))
+    return form_layouts.render_field(bound, label)
 
 
 @register.simple_tag
 def render_form(form, in_widget=False, show_legend=True):
     """ This template tag renders a form using fieldsets defined on a form, or simply all the fields
-        on the form if there is no defined fieldsets on the form.
+        on the form if there is no defined fieldsets on the form. The layout is compiled once per
+        form class, see base.form_layouts.
 
         Use the tag like this:
         {% render_form form %}
@@ -79,71 +37,7 @@ def render_form(form, in_widget=False, show_legend=True):
             {"id": "address": , "fields":["street", "number", "city", "zip"], "legend":"Address"},
          }
     """
-    def get_visible_inputs(form):
-        visible_inputs = []
-        for name, field in list(form.fields.items()):
-            if not isinstance(field.widget, field.hidden_widget):
-                visible_inputs.append(field)
-        return visible_inputs
-
-    # helper for rendering a list of fields
-    def get_fields_html(field_names, form):
-        fields_html = []
-        for field_name in field_names:
-            if field_name in form.fields:
-                fields_html.append(render_field(form[field_name]))
-        return ''.join(fields_html)
-
-    # helper for rendering fieldsets
-    def get_fieldsets_html(fieldsets, form, show_legend):
-        fieldset_html = '<fieldset id="{id}">{legend}' \
-                        '{title}<div>{fields}</div></fieldset>'
-
-        fieldsets_html = []
-        for fieldset in fieldsets:
-            legend = ''
-            if show_legend:
-                legend = "<legend>{legend}</legend>".format(legend=fieldset.get('legend', ''))
-            title = fieldset.get('title', '')
-            if title:
-                title = '<p class="title">{title}</p>'.format(title=title)
-            ctx = {
-                'id': fieldset.get('id', ''),
-                'legend': legend,
-                'fields': get_fields_html(fieldset.get('fields', list(form.fields.keys())), form),
-                'title': title,
-            }
-            fieldsets_html.append(fieldset_html.format(**ctx))
-
-        return ''.join(fieldsets_html)
-
-    errors = render_form_errors_helper(form)
-
-    # see if we have a meta class
-    exclude_names = []
-    if hasattr(form, 'Meta'):
-        meta = form.Meta
-
-        # meta class contains fieldsets
-        if hasattr(meta, 'fieldsets'):
-            if in_widget:
-                fieldset_string = '{errors}<div class="fieldset-container">{fieldsets}</div>'
-            else:
-                fieldset_string = '{errors}{fieldsets}'
-            return fieldset_string.format(errors=errors, fieldsets=get_fieldsets_html(meta.fieldsets, form, show_legend))
-
-        # no fieldsets in meta see if we have excludes
-        if hasattr(meta, 'excludes'):
-            exclude_names = meta.excludes
-
-    # get the field list and remove the excluded fields
-    field_names = list(form.fields.keys())
-    field_names = [x for x in field_names if x not in exclude_names]
-    if in_widget:
-        form_string = '{errors}<div class="fieldset-container"><fieldset><div>{fields}</div></fieldset></div>'
-    else:
-        form_string = '{errors}<fieldset><div>{fields}</div></fieldset>'
-    return mark_safe(form_string.format(errors=errors, fields=get_fields_html(field_names, form)))
+    return form_layouts.render_form(form, render_form_errors_helper(form), in_widget, show_legend)
 
 
 @register.simple_tag
@@ -175,13 +69,19 @@ def render_form_widget(context, form, title=None, show_legend=False, icon='icon-
         if hasattr(meta, 'fieldsets'):
             title = meta.fieldsets[0].get('legend', "Title")
 
-    context.update({
-        'widget_content': mark_safe(render_form(form, in_widget=True, show_legend=show_legend)),
+    # Only what widget_box.html and form_controlbox.html use, flattening the whole context is slow
+    controlbox = form_layouts.get_widget_template('includes/form_controlbox.html').render({
+        'button_style': context.get('button_style', ''),
+        'object': context.get('object'),
+        'allow_delete': context.get('allow_delete'),
+    })
+    return mark_safe(form_layouts.get_widget_template('includes/widget_box.html').render({
+        'widget_content': render_form(form, in_widget=True, show_legend=show_legend),
         'widget_title': title,
         'widget_icon': icon,
         'widget_description': desc,
-    })
-    return mark_safe(actions.render_template(None, 'includes/widget_box.html', context.flatten()))
+        'widget_controlbox': mark_safe(controlbox),
+    }))
 
 
 @register.filter
@@ -1,3 +1,462 @@
-from django.test import TestCasesumbit_captain_request
+import datetime
+import re
+import smtplib
 
-# Create your tests here.
+import ldap
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from base import actions, jobs, middleware, models, notifications, outbox
+from base import mail as base_mail
+from base.management.commands import certificates as certificates_command
+
+
+class FakeLDAP(object):
+    """
+    An in-process stand-in for a bound Active Directory connection, holding entries as
+    {dn: {attribute: [values]}}. Put an exception in failures[(dn, attribute)] to have the next
+    modification of that attribute raise it.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.failures = {}
+
+    def add_entry(self, dn, **attributes):
+        self.entries[dn] = dict((name, list(values)) for name, values in attributes.items())
+
+    def search_s(self, base_dn, scope, search_filter, attributes=None):
+        username = re.search(r'sAMAccountName=([^)]+)', search_filter).group(1)
+        return [(dn, dict(entry, distinguishedName=[dn])) for dn, entry in self.entries.items()
+                if entry.get('sAMAccountName') == [username]]
+
+    def add_s(self, dn, modlist):
+        if dn in self.entries:
+            raise ldap.ALREADY_EXISTS()
+        self.entries[dn] = dict((name, self._values(values)) for name, values in modlist)
+
+    def modify_s(self, dn, modlist):
+        if dn not in self.entries:
+            raise ldap.NO_SUCH_OBJECT()
+        # Like AD, a modify either applies completely or not at all
+        entry = dict((name, list(values)) for name, values in self.entries[dn].items())
+        for operation, name, values in modlist:
+            failure = self.failures.pop((dn, name), None)
+            if failure is not None:
+                raise failure
+            values = self._values(values)
+            if operation == ldap.MOD_ADD:
+                if set(values) & set(entry.get(name, [])):
+                    raise ldap.TYPE_OR_VALUE_EXISTS()
+                entry.setdefault(name, []).extend(values)
+            elif operation == ldap.MOD_REPLACE:
+                entry[name] = values
+            elif operation == ldap.MOD_DELETE:
+                if set(values) - set(entry.get(name, [])):
+                    raise ldap.NO_SUCH_ATTRIBUTE()
+                entry[name] = [value for value in entry[name] if value not in values]
+        self.entries[dn] = entry
+
+    @staticmethod
+    def _values(values):
+        return list(values) if isinstance(values, (list, tuple)) else [values]
+
+
+class FakePool(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def acquire(self):
+        return self.connection
+
+    def release(self, connection, discard=False):
+        pass
+
+
+class FakeAuth(object):
+    def get_or_create_user(self, username, password):
+        return User.objects.get_or_create(username=username)[0]
+
+
+class FakeLDAPMixin(object):
+    """
+    Runs the LDAP actions against a FakeLDAP holding the blue team group.
+    """
+
+    def setUp(self):
+        super(FakeLDAPMixin, self).setUp()
+        self.ldap = FakeLDAP()
+        self.group_dn = 'CN={group},OU={ou},{base}'.format(group=settings.AD_CDCUSER_GROUP, ou=settings.AD_CDCUSER_OU,
+                                                          base=settings.AD_BASE_DN)
+        self.user_dn = 'CN=John Doe,OU={ou},{base}'.format(ou=settings.AD_CDCUSER_OU, base=settings.AD_BASE_DN)
+        self.ldap.add_entry(self.group_dn)
+
+        self.pool, actions.ADMIN_POOL = actions.ADMIN_POOL, FakePool(self.ldap)
+        self.auth, actions.AD_AUTH = actions.AD_AUTH, FakeAuth()
+
+    def tearDown(self):
+        actions.ADMIN_POOL = self.pool
+        actions.AD_AUTH = self.auth
+        super(FakeLDAPMixin, self).tearDown()
+
+
+@override_settings(LDAP_ASYNC=True, AD_DEBUG_FILE=None, LDAP_JOB_MAX_ATTEMPTS=5, LDAP_JOB_BACKOFF=5)
+class LDAPJobTests(FakeLDAPMixin, TestCase):
+    USERNAME = 'jdoe'
+    EMAIL = 'jdoe@example.com'
+
+    def queue_signup(self):
+        return jobs.enqueue('create_account', username=self.USERNAME, fname='John', lname='Doe', email=self.EMAIL,
+                            color='blue')
+
+    def run_next(self):
+        job = jobs.claim_next()
+        self.assertIsNotNone(job)
+        return jobs.run_job(job)
+
+    def assert_account_created(self):
+        entry = self.ldap.entries[self.user_dn]
+        self.assertEqual(entry['userAccountControl'], ['512'])
+        self.assertEqual(len(entry['unicodePwd']), 1)
+        self.assertEqual(self.ldap.entries[self.group_dn]['member'], [self.user_dn])
+        self.assertTrue(User.objects.filter(username=self.USERNAME).exists())
+
+    def test_create_account(self):
+        self.queue_signup()
+        job = self.run_next()
+
+        self.assertEqual(job.status, models.LDAPJob.DONE)
+        self.assert_account_created()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.USERNAME, mail.outbox[0].body)
+
+    def test_create_account_resumes_after_failed_step(self):
+        self.queue_signup()
+        self.ldap.failures[(self.user_dn, 'unicodePwd')] = ldap.SERVER_DOWN()
+        job = self.run_next()
+
+        self.assertEqual(job.status, models.LDAPJob.PENDING)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(self.ldap.entries[self.user_dn]['userAccountControl'], ['514'])
+
+        models.LDAPJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        job = self.run_next()
+
+        self.assertEqual(job.status, models.LDAPJob.DONE)
+        self.assert_account_created()
+        # Only the account created email, not a username taken one
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("successfully created", mail.outbox[0].body)
+
+    def test_taken_username_fails_and_tells_the_applicant(self):
+        self.ldap.add_entry('CN=Someone Else,OU=Other,' + settings.AD_BASE_DN, sAMAccountName=[self.USERNAME],
+                            mail=['someone@example.com'], userAccountControl=['512'])
+        self.queue_signup()
+        job = self.run_next()
+
+        self.assertEqual(job.status, models.LDAPJob.FAILED)
+        self.assertNotIn(self.user_dn, self.ldap.entries)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("already taken", mail.outbox[0].body)
+
+    def test_enabled_account_with_the_same_email_is_taken(self):
+        # e.g. a returning participant whose Django user was removed by compreset
+        self.ldap.add_entry(self.user_dn, sAMAccountName=[self.USERNAME], mail=[self.EMAIL],
+                            userAccountControl=['512'])
+        self.queue_signup()
+        job = self.run_next()
+
+        self.assertEqual(job.status, models.LDAPJob.FAILED)
+        self.assertIn('UsernameAlreadyExistsError', job.last_error)
+        self.assertEqual(self.ldap.entries[self.group_dn].get('member', []), [])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("already taken", mail.outbox[0].body)
+
+    def test_group_changes(self):
+        self.ldap.add_entry(self.user_dn)
+        self.assertTrue(actions.add_user_to_group(self.user_dn, self.group_dn))
+        self.assertEqual(self.ldap.entries[self.group_dn]['member'], [self.user_dn])
+        # AD refuses to add a member twice
+        self.assertFalse(actions.add_user_to_group(self.user_dn, self.group_dn))
+        self.assertTrue(actions.remove_user_from_group(self.user_dn, self.group_dn))
+        self.assertEqual(self.ldap.entries[self.group_dn]['member'], [])
+
+    def test_backoff_only_holds_up_the_same_participant(self):
+        first = models.Participant.objects.get(user=User.objects.create(username='first'))
+        second = models.Participant.objects.get(user=User.objects.create(username='second'))
+        later = timezone.now() + datetime.timedelta(minutes=5)
+
+        waiting = jobs.enqueue('add_user_to_group', participant=first, user_dn='CN=First', group_dn=self.group_dn)
+        models.LDAPJob.objects.filter(pk=waiting.pk).update(run_after=later)
+        blocked = jobs.enqueue('remove_user_from_group', participant=first, user_dn='CN=First', group_dn=self.group_dn)
+        other = jobs.enqueue('add_user_to_group', participant=second, user_dn='CN=Second', group_dn=self.group_dn)
+
+        self.assertEqual(jobs.claim_next().pk, other.pk)
+        self.assertIsNone(jobs.claim_next())
+
+        models.LDAPJob.objects.filter(pk=waiting.pk).update(run_after=timezone.now())
+        self.assertEqual(jobs.claim_next().pk, waiting.pk)
+        # Still held up while the earlier job runs
+        self.assertIsNone(jobs.claim_next())
+        models.LDAPJob.objects.filter(pk=waiting.pk).update(status=models.LDAPJob.DONE)
+        self.assertEqual(jobs.claim_next().pk, blocked.pk)
+
+
+# Batched group changes wait for the transaction to commit, which TestCase never does
+@override_settings(LDAP_ASYNC=False, AD_DEBUG_FILE=None)
+class GroupChangeTests(FakeLDAPMixin, TransactionTestCase):
+    FIRST = 'CN=First,OU=CDCUsers,DC=iseage,DC=org'
+    SECOND = 'CN=Second,OU=CDCUsers,DC=iseage,DC=org'
+
+    def members(self):
+        return self.ldap.entries[self.group_dn].get('member', [])
+
+    def test_batched_changes_are_applied_on_commit(self):
+        with transaction.atomic():
+            with actions.batch_group_changes():
+                actions.queue_group_change(None, self.FIRST, self.group_dn)
+                actions.queue_group_change(None, self.SECOND, self.group_dn)
+            self.assertEqual(self.members(), [])
+        self.assertEqual(self.members(), [self.FIRST, self.SECOND])
+
+    def test_batched_changes_are_dropped_when_the_block_raises(self):
+        with self.assertRaises(RuntimeError):
+            with actions.batch_group_changes():
+                actions.queue_group_change(None, self.FIRST, self.group_dn)
+                raise RuntimeError()
+        self.assertEqual(self.members(), [])
+
+    def test_batched_changes_are_dropped_on_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                with actions.batch_group_changes():
+                    actions.queue_group_change(None, self.FIRST, self.group_dn)
+                raise RuntimeError()
+        self.assertEqual(self.members(), [])
+
+    def test_atomic_block_inside_the_batch_is_rolled_back_with_it(self):
+        with self.assertRaises(RuntimeError):
+            with actions.batch_group_changes(), transaction.atomic():
+                User.objects.create(username='jdoe')
+                actions.queue_group_change(None, self.FIRST, self.group_dn)
+                raise RuntimeError()
+        self.assertFalse(User.objects.filter(username='jdoe').exists())
+        self.assertEqual(self.members(), [])
+
+    def test_modify_group_members_applies_what_it_can(self):
+        self.ldap.entries[self.group_dn]['member'] = [self.FIRST]
+        # AD rejects the whole modify because FIRST is already a member
+        self.assertFalse(actions.modify_group_members(self.group_dn, [self.FIRST, self.SECOND], []))
+        self.assertEqual(self.members(), [self.FIRST, self.SECOND])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class UserDNCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='jdoe', first_name='John', last_name='Doe')
+        self.key = actions.USER_DN_KEY.format(id=self.user.participant.pk)
+        cache.set(self.key, 'CN=John Doe,OU=CDCUsers,DC=iseage,DC=org')
+
+    def test_login_keeps_the_cached_dn(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.last_login = timezone.now()
+        user.save()
+        self.assertIsNotNone(cache.get(self.key))
+
+    def test_renaming_forgets_the_cached_dn(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.last_name = 'Smith'
+        user.save()
+        self.assertIsNone(cache.get(self.key))
+
+
+class CountingBackend(BaseEmailBackend):
+    """
+    An email backend that counts the connections it opens. Put SMTP errors in failures to have the
+    next sends raise them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingBackend, self).__init__(*args, **kwargs)
+        self.connected = False
+        self.opened = 0
+        self.sent = []
+        self.failures = []
+
+    def open(self):
+        if not self.connected:
+            self.connected = True
+            self.opened += 1
+
+    def close(self):
+        self.connected = False
+
+    def send_messages(self, email_messages):
+        if not self.connected:
+            # What the SMTP backend does without an open connection
+            self.open()
+            try:
+                return self.send_messages(email_messages)
+            finally:
+                self.close()
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.extend(email_messages)
+        return len(email_messages)
+
+
+@override_settings(EMAIL_RATE_PER_MINUTE=0)
+class MailDispatcherTests(SimpleTestCase):
+    def message(self, number):
+        return EmailMessage("Subject", "Body", 'support@example.com', ['{}@example.com'.format(number)])
+
+    def test_messages_share_one_connection(self):
+        backend = CountingBackend()
+        with base_mail.MailDispatcher(connection=backend) as dispatcher:
+            for number in range(3):
+                dispatcher.send(self.message(number))
+            self.assertTrue(backend.connected)
+
+        self.assertEqual(backend.opened, 1)
+        self.assertEqual(len(backend.sent), 3)
+        self.assertFalse(backend.connected)
+
+    def test_reconnects_after_an_error(self):
+        backend = CountingBackend()
+        backend.failures.append(smtplib.SMTPServerDisconnected())
+        with base_mail.MailDispatcher(connection=backend) as dispatcher:
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                dispatcher.send(self.message(1))
+            dispatcher.send(self.message(2))
+            dispatcher.send(self.message(3))
+
+        self.assertEqual(backend.opened, 2)
+        self.assertEqual((dispatcher.sent, dispatcher.failed), (2, 1))
+
+
+@override_settings(EMAIL_RATE_PER_MINUTE=0)
+class OutboxTests(TestCase):
+    def setUp(self):
+        sender = User.objects.create(username='admin')
+        self.archived = models.ArchivedEmail.objects.create(subject="Subject", content="Body", audience='everyone',
+                                                            sender=sender)
+        outbox.queue_email(self.archived, ['{}@example.com'.format(number) for number in range(6)])
+
+    def send(self, backend, batch_size):
+        ids = list(self.archived.recipients.values_list('id', flat=True))
+        batches = queue.Queue()
+        for i in range(0, len(ids), batch_size):
+            batches.put(ids[i:i + batch_size])
+        thread = outbox.SenderThread(batches, None)
+        thread.dispatcher.connection = backend
+        thread.run()
+        return thread
+
+    def test_one_session_per_batch(self):
+        backend = CountingBackend()
+        thread = self.send(backend, 3)
+
+        self.assertEqual(backend.opened, 2)
+        self.assertEqual(thread.sent, 6)
+        self.assertEqual(self.archived.recipients.filter(status=models.EmailRecipient.SENT).count(), 6)
+
+    def test_failed_send_reconnects_and_defers(self):
+        backend = CountingBackend()
+        backend.failures.append(smtplib.SMTPServerDisconnected())
+        thread = self.send(backend, 6)
+
+        self.assertEqual(backend.opened, 2)
+        self.assertEqual((thread.sent, thread.failed), (5, 1))
+        self.assertEqual(self.archived.recipients.filter(status=models.EmailRecipient.DEFERRED).count(), 1)
+
+
+class FailingBackend(BaseEmailBackend):
+    """
+    Delivers to mail.outbox like the locmem backend, except to the addresses in refused.
+    """
+    refused = set()
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            if set(message.to) & self.refused:
+                raise smtplib.SMTPRecipientsRefused(dict((to, (450, "Try again later")) for to in message.to))
+            mail.outbox.append(message)
+        return len(email_messages)
+
+
+@override_settings(CAPTAIN_DIGEST_WINDOW=900, EMAIL_RATE_PER_MINUTE=0,
+                   EMAIL_BACKEND='base.tests.FailingBackend')
+class CaptainDigestTests(TestCase):
+    def setUp(self):
+        self.team = models.Team.objects.create(name="Team", number=1)
+        self.captains = []
+        for name in ('first', 'second'):
+            user = User.objects.create(username=name, first_name=name, email='{}@example.com'.format(name))
+            # Skip the AD group signals
+            models.Participant.objects.filter(user=user).update(team=self.team, captain=True)
+            self.captains.append(user)
+        member = User.objects.create(username='member', first_name='New', last_name='Member')
+        notifications.notify_captains(self.team, models.CaptainNotification.MEMBER_JOINED, member.participant)
+
+    def tearDown(self):
+        FailingBackend.refused = set()
+
+    def test_failed_captain_gets_the_digest_on_the_next_flush(self):
+        FailingBackend.refused = {'second@example.com'}
+        self.assertEqual(notifications.flush(window=0), 1)
+        self.assertEqual([message.to for message in mail.outbox], [['first@example.com']])
+        self.assertFalse(models.CaptainNotification.objects.filter(sent_time__isnull=False).exists())
+
+        FailingBackend.refused = set()
+        self.assertEqual(notifications.flush(window=0), 1)
+        self.assertEqual([message.to for message in mail.outbox], [['first@example.com'], ['second@example.com']])
+        self.assertFalse(models.CaptainNotification.objects.filter(sent_time__isnull=True).exists())
+
+
+class SessionValueTests(SimpleTestCase):
+    def test_lazy_value_does_not_mark_the_session_modified(self):
+        session = SessionStore()
+        middleware.set_session_value_lazily(session, 'recent_path', '/dashboard/')
+        self.assertEqual(session['recent_path'], '/dashboard/')
+        self.assertFalse(session.modified)
+
+    def test_unchanged_value_does_not_mark_the_session_modified(self):
+        session = SessionStore()
+        middleware.set_session_value(session, 'ip_addr', '10.0.0.1')
+        self.assertTrue(session.modified)
+        session.modified = False
+        middleware.set_session_value(session, 'ip_addr', '10.0.0.1')
+        self.assertFalse(session.modified)
+
+
+class BrokenRenderer(object):
+    def render(self, fields):
+        if dict(fields)['participant_name'] == 'Jane Doe':
+            raise ValueError("bad field")
+        return b'%PDF'
+
+
+class RenderCertificateTests(SimpleTestCase):
+    def setUp(self):
+        certificates_command._renderer = BrokenRenderer()
+
+    def tearDown(self):
+        certificates_command._renderer = None
+
+    def test_render_failures_are_returned(self):
+        def job(username, name):
+            return username, [('participant_name', name)]
+
+        self.assertEqual(certificates_command.render_certificate(job('jdoe', 'John Doe')), ('jdoe', b'%PDF', None))
+        username, pdf, error = certificates_command.render_certificate(job('jane', 'Jane Doe'))
+        self.assertEqual((username, pdf), ('jane', None))
+        self.assertIn('bad field', error)
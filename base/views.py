@@ -4,8 +4,10 @@ from django.contrib.auth import views as auth_views
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Count
 from django.db.models.query_utils import Q
-from django.http import Http404
+from django.http import Http404, JsonResponse
 from django.shortcuts import redirect, get_object_or_404
 from django.utils import timezone
 from django.utils.decorators import method_decorator
@@ -15,7 +17,7 @@ from django.views.generic.base import View, TemplateResponseMixin
 import base
 from base import breadcrumbs, utils
 from base.models import ArchivedEmail
-from . import actions
+from . import actions, jobs, outbox
 from . import forms as base_forms
 from . import models, forms
 
@@ -25,6 +27,10 @@ If that still didn't work, please email us at {support} so we can fix it.""".for
 WHOOPS = """Whoops! Something went wrong on our end. \
 Please email us at {support} so we can fix it.""".format(support=settings.SUPPORT_EMAIL)
 
+ACCOUNT_REQUESTED = "Your account request has been received. Please check your email for further instructions."
+
+USERNAME_TAKEN = "That username already exists. Please choose another one."
+
 CREATION_DISABLED = """Account Creation is currently disabled. \
 Email us at {support} if you need to make an account.""".format(support=settings.SUPPORT_EMAIL)
 
@@ -163,7 +169,9 @@ class AdminDashboard(LoginRequiredMixin, UserIsAdminMixin, BaseTemplateView):
         if request.GET.get('email_list'):
             context['emails'] = User.objects.filter(is_superuser=False).values_list('email', flat=True)
 
-        context['archive'] = models.ArchivedEmail.objects.all()
+        context['archive'] = models.ArchivedEmail.objects.with_delivery_counts()
+        context['delivery_totals'] = dict(models.EmailRecipient.objects.values_list('status')
+                                          .annotate(count=Count('id')).order_by())
         context['participant_approvals'] = {
             'title': 'Red/Green Approvals',
             'icon': 'fa-check',
@@ -176,6 +184,10 @@ class AdminDashboard(LoginRequiredMixin, UserIsAdminMixin, BaseTemplateView):
             'title': 'Email Archive',
             'icon': 'fa-book'
         }
+        context['email_delivery'] = {
+            'title': 'Email Delivery',
+            'icon': 'fa-envelope-o',
+        }
         context['danger_zone'] = {
             'title': 'Danger Zone',
             'icon': 'fa-exclamation-triangle',
@@ -231,6 +243,14 @@ class RedGreenUnapprove(LoginRequiredMixin, UserIsAdminMixin, BaseTemplateView):
         return redirect(reverse('admin-approvals'))
 
 
+class AdminResumeEmailView(LoginRequiredMixin, UserIsAdminMixin, BaseTemplateView):
+    def get(self, request, context, *args, **kwargs):
+        archived = get_object_or_404(models.ArchivedEmail, pk=kwargs['email_id'])
+        count = outbox.resume(archived, include_failed=request.GET.get('failed') == 'true')
+        messages.success(request, "Queued {} undelivered message(s) again".format(count))
+        return redirect(reverse('admin-dash'))
+
+
 class AdminCompetitionResetView(LoginRequiredMixin, UserIsAdminMixin, BaseTemplateView):
     template_name = 'competition_reset.html'
     page_title = "Competition Reset"
@@ -246,9 +266,10 @@ class AdminCompetitionResetView(LoginRequiredMixin, UserIsAdminMixin, BaseTempla
         return self.render_to_response(context)
 
     def post(self, request, context, *args, **kwargs):
-        User.objects.exclude(is_superuser=True).delete()
-        models.Team.objects.all().delete()
-        ArchivedEmail.objects.all().delete()
+        with actions.batch_group_changes(), transaction.atomic():
+            User.objects.exclude(is_superuser=True).delete()
+            models.Team.objects.all().delete()
+            ArchivedEmail.objects.all().delete()
         messages.success(request, 'Competition successfully reset.')
         return redirect('admin-dash')
 
@@ -362,17 +383,22 @@ class SignupView(BaseTemplateView):
             first = form.cleaned_data['first_name'].strip()
             last = form.cleaned_data['last_name'].strip()
             username = form.cleaned_data['username'].replace(' ', '')
+            if User.objects.filter(username=username).exists():
+                form.add_error('username', USERNAME_TAKEN)
+                return self.get(request, context, form=form)
+
             success = False
             try:
-                success = actions.create_user_account(username, first, last, email)
+                success = jobs.enqueue('create_account', username=username, fname=first, lname=last, email=email,
+                                       color='blue')
             except base.DuplicateName:
                 form.add_error('first_name', """It looks like there's already an account with the same first and last names as you provided. \
                 Try including your middle initial or middle name.""")
             except base.UsernameAlreadyExistsError:
-                form.add_error('username', "That username already exists. Please choose another one.")
+                form.add_error('username', USERNAME_TAKEN)
                 return self.get(request, context, form=form)
             if success:
-                messages.success(request, 'Account successfully created. Please check your email for further instructions.')
+                messages.success(request, ACCOUNT_REQUESTED)
                 return redirect('site-login')
             else:
                 messages.error(request, TRY_AGAIN)
@@ -411,22 +437,22 @@ class RedSignup(BaseTemplateView):
         form = forms.SignupForm(request.POST)
         if form.is_valid():
             cd = form.cleaned_data
+            if User.objects.filter(username=cd['username']).exists():
+                form.add_error('username', USERNAME_TAKEN)
+                return self.get(request, context, form=form)
+
             success = False
             try:
-                success = actions.create_user_account(cd['username'], cd['first_name'], cd['last_name'], cd['email'],
-                                                      "red")
+                success = jobs.enqueue('create_account', username=cd['username'], fname=cd['first_name'],
+                                       lname=cd['last_name'], email=cd['email'], color="red")
             except base.DuplicateName:
                 form.add_error('first_name', """It looks like there's already an account with the same first and last names as you provided. \
                     Try including your middle initial or middle name.""")
             except base.UsernameAlreadyExistsError:
-                form.add_error('username', "That username already exists. Please choose another one.")
+                form.add_error('username', USERNAME_TAKEN)
                 return self.get(request, context, form=form)
             if success:
-                user = User.objects.get(username=cd['username'])
-                user.participant.is_red = True
-                user.participant.save()
-                messages.success(request,
-                                 'Account successfully created. Please check your email for further instructions.')
+                messages.success(request, ACCOUNT_REQUESTED)
                 return redirect('site-login')
             else:
                 messages.error(request, TRY_AGAIN)
@@ -460,22 +486,22 @@ class GreenSignup(BaseTemplateView):
         form = forms.SignupForm(request.POST)
         if form.is_valid():
             cd = form.cleaned_data
+            if User.objects.filter(username=cd['username']).exists():
+                form.add_error('username', USERNAME_TAKEN)
+                return self.get(request, context, form=form)
+
             success = False
             try:
-                success = actions.create_user_account(cd['username'], cd['first_name'], cd['last_name'], cd['email'],
-                                                      "green")
+                success = jobs.enqueue('create_account', username=cd['username'], fname=cd['first_name'],
+                                       lname=cd['last_name'], email=cd['email'], color="green")
             except base.DuplicateName:
                 form.add_error('first_name', """It looks like there's already an account with the same first and last names as you provided. \
                     Try including your middle initial or middle name.""")
             except base.UsernameAlreadyExistsError:
-                form.add_error('username', "That username already exists. Please choose another one.")
+                form.add_error('username', USERNAME_TAKEN)
                 return self.get(request, context, form=form)
             if success:
-                user = User.objects.get(username=cd['username'])
-                user.participant.is_green = True
-                user.participant.save()
-                messages.success(request,
-                                 'Account successfully created. Please check your email for further instructions.')
+                messages.success(request, ACCOUNT_REQUESTED)
                 return redirect('site-login')
             else:
                 messages.error(request, TRY_AGAIN)
@@ -507,12 +533,13 @@ class DashboardView(LoginRequiredMixin, BaseTemplateView):
             team = participant.team
             if team:
                 context['team'] = team
-                context['current_members'] = team.members()
+                context['current_members'] = team.get_roster()
                 context['captain_requested'] = participant.requests_captain
             else:
                 context['looking_for_team'] = participant.looking_for_team
             if participant.captain:
                 context['is_captain'] = True
+            context['pending_ldap_jobs'] = jobs.get_participant_jobs(participant).exists()
             if participant.is_redgreen:
                 context['is_redgreen'] = True
                 context['is_green'] = participant.is_green
@@ -541,7 +568,12 @@ class DashboardView(LoginRequiredMixin, BaseTemplateView):
 
         context['ISCORE_URL'] = settings.ISCORE_URL
 
-        context['archived_emails'] = models.ArchivedEmail.objects.filter(audience__in=utils.get_user_audience(request.user))
+        # The important information widget is cached per audience set, the archive is only queried on a miss
+        audience = utils.get_user_audience(request.user)
+        context['audience'] = ','.join(sorted(audience))
+        context['fragment_version'] = actions.get_fragment_version()
+        context['fragment_timeout'] = settings.DASHBOARD_FRAGMENT_TIMEOUT
+        context['archived_emails'] = models.ArchivedEmail.objects.filter(audience__in=audience)
 
         context['important_info'] = {
             'title': 'Important Information',
@@ -570,6 +602,25 @@ class DashboardView(LoginRequiredMixin, BaseTemplateView):
         return self.get(request, context, form=form)
 
 
+class LDAPJobStatusView(LoginRequiredMixin, BaseView):
+    """
+    JSON status of the participant's queued Active Directory changes, polled by the dashboard.
+    """
+    def get(self, request, context, *args, **kwargs):
+        unfinished = jobs.get_participant_jobs(request.user.participant)
+        return JsonResponse({
+            'pending': unfinished.exclude(status=models.LDAPJob.FAILED).count(),
+            'failed': unfinished.filter(status=models.LDAPJob.FAILED).count(),
+            'jobs': [{
+                'id': job.id,
+                'action': job.action,
+                'status': job.status,
+                'attempts': job.attempts,
+                'updated': job.updated.isoformat(),
+            } for job in unfinished],
+        })
+
+
 class ArchiveEmailView(LoginRequiredMixin, BaseTemplateView):
     template_name = 'email_view.html'
     page_title = 'Archived Email'
@@ -652,9 +703,9 @@ class TeamListView(LoginRequiredMixin, BaseTemplateView):
     breadcrumb = 'Team list'
 
     def get(self, request, context, *args, **kwargs):
-        teams = actions.get_current_teams()
-        if len(teams):
-            context['teams'] = actions.get_current_teams()
+        teams = actions.get_current_teams().with_roster()
+        if teams:
+            context['teams'] = teams
         return self.render_to_response(context)
 
 
@@ -868,9 +919,9 @@ class CaptainHomeView(LoginRequiredMixin, UserIsCaptainMixin, BaseTemplateView):
             'icon': 'fa-warning',
         }
 
-        context['current_members'] = team.members()
-        context['member_requests'] = team.requested_members()
-        context['captain_requests'] = team.requested_captains()
+        context['current_members'] = team.get_roster()
+        context['member_requests'] = team.get_requester_roster()
+        context['captain_requests'] = team.get_captain_request_roster()
 
         return self.render_to_response(context)
 
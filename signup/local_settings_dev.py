@@ -6,6 +6,13 @@ SESSION_COOKIE_SECURE = False
 AD_DEBUG = True
 AD_LDAP_DEBUG_LEVEL = 2
 
+# Talk to AD inside the request so runserver works without an ldapworker
+LDAP_ASYNC = False
+# Same for the email outbox and sendoutbox
+EMAIL_OUTBOX_ASYNC = False
+EMAIL_RATE_PER_MINUTE = 0
+CAPTAIN_DIGEST_WINDOW = 0
+
 DEBUG = True
 TEMPLATE_DEBUG = True
 
@@ -122,8 +122,10 @@ STATICFILES_FINDERS = (
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'base.middleware.SlidingSessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'base.middleware.ParticipantMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
@@ -159,8 +161,14 @@ INSTALLED_APPS = (
 LOGIN_URL = URL_ROOT + 'login/'
 LOGOUT_URL = URL_ROOT + 'logout/'
 LOGIN_REDIRECT_URL = URL_ROOT
-SESSION_SAVE_EVERY_REQUEST = True  # http://stackoverflow.com/questions/1366146/django-session-expiry
+# Sessions are only written when they change; SlidingSessionMiddleware pushes the expiry back
+# at most every SESSION_REFRESH_INTERVAL seconds
+SESSION_SAVE_EVERY_REQUEST = False
 SESSION_COOKIE_AGE = 60 * 60  # age in seconds
+SESSION_REFRESH_INTERVAL = 5 * 60  # seconds
+# Read sessions from memcached, falling back to the database. 'django.contrib.sessions.backends.cache'
+# drops the database entirely, at the cost of logging everyone out when memcached restarts
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 SESSION_COOKIE_SECURE = True
 DEFAULT_NEXT_URL = "/"
 
@@ -176,6 +184,21 @@ SUPPORT_EMAIL = 'cdc_support@iastate.edu'
 # What will appear in the From field of emails
 EMAIL_FROM_ADDR = SUPPORT_EMAIL
 
+# Send participant emails from the EmailRecipient outbox (see the sendoutbox command)
+EMAIL_OUTBOX_ASYNC = True
+EMAIL_OUTBOX_WORKERS = 4  # SMTP connections used in parallel
+EMAIL_OUTBOX_BATCH_SIZE = 50  # messages sent over one connection before taking the next batch
+EMAIL_OUTBOX_POLL_INTERVAL = 5  # seconds
+
+# Seconds captain notifications are collected for before flushnotifications sends them as one digest.
+# 0 emails the captains about every event right away
+CAPTAIN_DIGEST_WINDOW = 15 * 60
+CAPTAIN_DIGEST_POLL_INTERVAL = 60  # seconds
+
+# Sending budget of base.mail.MailDispatcher, shared by all the connections of one command. 0 means unlimited
+EMAIL_RATE_PER_MINUTE = 120
+EMAIL_RATE_BURST = 20
+
 
 ##############
 # Caching
@@ -186,6 +209,12 @@ CACHES = {
         'LOCATION': '127.0.0.1:11211',
     }
 }
+# Seconds a process uses its copy of GlobalSettings before checking the version in the cache again.
+# Requests always check once at their start
+GLOBAL_SETTINGS_CHECK_INTERVAL = 5
+# Seconds to keep dashboard fragments that only depend on the global settings and email archive.
+# Saving either changes the key, so this only bounds how long stale fragments sit in memcached
+DASHBOARD_FRAGMENT_TIMEOUT = 60 * 60 * 24
 
 
 ##############
@@ -220,6 +249,15 @@ AD_CERT_FILE = False  # this is the certificate of the Certificate Authority iss
 AD_DEBUG = False
 AD_LDAP_DEBUG_LEVEL = 0
 AD_DEBUG_FILE = '/var/log/signup/ldap.debug'
+DN_CACHE_TIMEOUT = 60 * 60 * 24  # seconds to cache participant and team distinguished names
+AD_POOL_SIZE = 4  # max number of idle admin connections kept per worker process
+AD_POOL_CHECK_INTERVAL = 60  # seconds a pooled connection can sit idle before it is health-checked on reuse
+
+# Run AD operations from the request path through the LDAPJob queue (see the ldapworker command)
+LDAP_ASYNC = True
+LDAP_JOB_MAX_ATTEMPTS = 5
+LDAP_JOB_BACKOFF = 5  # seconds before the first retry, doubled on every further attempt
+LDAP_JOB_POLL_INTERVAL = 2  # seconds
 
 AUTHENTICATION_BACKENDS = (
     'base.auth.ActiveDirectoryAuthenticationBackend',
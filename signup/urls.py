@@ -28,6 +28,7 @@ urlpatterns = (
 
     url(r'^admin/$', views.AdminDashboard.as_view(), name='admin-dash'),
     url(r'^admin/email/$', views.AdminSendEmailView.as_view(), name='admin-email'),
+    url(r'^admin/email/(?P<email_id>\d+)/resume/$', views.AdminResumeEmailView.as_view(), name='admin-email-resume'),
     url(r'^admin/reset/$', views.AdminCompetitionResetView.as_view(), name='admin-reset'),
     url(r'^admin/approvals/$', views.RedGreenApprovals.as_view(), name='admin-approvals'),
     url(r'^admin/approvals/(?P<participant_id>\d+)/approve', views.RedGreenApprove.as_view(), name='admin-approve'),
@@ -53,6 +54,7 @@ urlpatterns = (
     url(r'^dashboard/step_down/$', views.StepDownView.as_view(), name='step-down'),
     url(r'^dashboard/create_team/$', views.TeamCreationView.as_view(), name='create-team'),
     url(r'^dashboard/toggle_lft/$', views.ToggleLFTView.as_view(), name='toggle-lft'),
+    url(r'^dashboard/ldap_status/$', views.LDAPJobStatusView.as_view(), name='ldap-status'),
 
     url(r'^dashboard/manage_team/$', views.CaptainHomeView.as_view(), name='manage-team'),
     url(r'^dashboard/manage_team/approve_member/(?P<participant_id>[0-9-_:]+)/$', views.ApproveMemberView.as_view(), name='approve-member'),